@@ -1,39 +1,146 @@
 #!/usr/bin/env python3
 
+import os
 import logging
 import argparse
 import warnings
-from datetime import datetime, timezone
+from datetime import datetime, timezone, timedelta
+from functools import partial
+from pathlib import Path
 import numpy
-import scipy
 from sunpy.map import Map
 from aiapy.calibrate import fix_observer_location, update_pointing, normalize_exposure, register, correct_degradation
+from aiapy.calibrate.util import get_pointing_table, get_correction_table
 from astropy.io import fits
+from astropy.table import QTable
+from astropy.time import Time
 
-__all__ = ['calibrate_aia_map', 'calibrated_aia_fits_file']
+from pixel_stats import PixelStats
 
-def calibrate_aia_map(map):
-	'''Take an AIA map, pass it through the calibration procedures of aiapy and update the map meta'''
+__all__ = ['CalibrationContext', 'calibrate_aia_map', 'calibrated_aia_fits_file']
+
+class CalibrationContext:
+	'''Pointing and degradation correction tables used by the calibration, fetched once for a range of dates instead of once per map
+	The tables can be kept in a cache directory as ECSV files, so that later runs for dates already covered work offline'''
+	
+	# Name of the cache files of the tables
+	POINTING_TABLE_FILE = 'pointing_table.ecsv'
+	CORRECTION_TABLE_FILE = 'correction_table.ecsv'
+	
+	# Margin around the range of dates for the pointing table, because the pointing of a map is taken from the entry preceding its date
+	POINTING_MARGIN = timedelta(hours = 12)
+	
+	def __init__(self, pointing_table = None, correction_table = None):
+		self.pointing_table = pointing_table
+		self.correction_table = correction_table
+	
+	@classmethod
+	def load(cls, start_date, end_date, cache_directory = None):
+		'''Return a context with the tables for the range of dates, read from the cache directory if they cover the range, or fetched and written to the cache directory'''
+		
+		pointing_table = None
+		correction_table = None
+		
+		if cache_directory is not None:
+			cache_directory = Path(cache_directory)
+			cache_directory.mkdir(parents = True, exist_ok = True)
+			pointing_table = cls._read_table(cache_directory / cls.POINTING_TABLE_FILE)
+			correction_table = cls._read_table(cache_directory / cls.CORRECTION_TABLE_FILE)
+		
+		fetch_start_date = start_date - cls.POINTING_MARGIN
+		fetch_end_date = end_date + cls.POINTING_MARGIN
+		
+		# The range covered by the pointing table is taken from its entries, because the table has no entry for dates not yet available when it was fetched
+		if pointing_table is not None:
+			covered_start_date, covered_end_date = cls._get_covered_range(pointing_table)
+			if covered_start_date is None or covered_start_date > start_date or covered_end_date < end_date:
+				# Fetch the union of the ranges, so that the cache keeps growing
+				if covered_start_date is not None:
+					fetch_start_date = min(fetch_start_date, covered_start_date)
+					fetch_end_date = max(fetch_end_date, covered_end_date)
+				pointing_table = None
+		
+		if pointing_table is None:
+			logging.info('Fetching pointing table from %s to %s', fetch_start_date, fetch_end_date)
+			pointing_table = get_pointing_table(Time(fetch_start_date), Time(fetch_end_date))
+			if cache_directory is not None:
+				cls._write_table(pointing_table, cache_directory / cls.POINTING_TABLE_FILE)
+		
+		# The correction table covers the whole mission, delete the cache file to get a new calibration version
+		if correction_table is None:
+			logging.info('Fetching degradation correction table')
+			correction_table = get_correction_table()
+			if cache_directory is not None:
+				cls._write_table(correction_table, cache_directory / cls.CORRECTION_TABLE_FILE)
+		
+		return cls(pointing_table, correction_table)
+	
+	@staticmethod
+	def _get_covered_range(pointing_table):
+		'''Return the first start and last stop date of the entries of the pointing table, or (None, None) if it has no entry'''
+		if len(pointing_table) == 0:
+			return None, None
+		return Time(pointing_table['T_START']).min().utc.to_datetime(), Time(pointing_table['T_STOP']).max().utc.to_datetime()
+	
+	@staticmethod
+	def _read_table(file_path):
+		'''Return the table in the ECSV file, or None if the file does not exist or cannot be read'''
+		if not file_path.exists():
+			return None
+		try:
+			return QTable.read(file_path, format = 'ascii.ecsv')
+		except Exception as why:
+			logging.warning('Could not read table from file %s: %s', file_path, why)
+			return None
+	
+	@staticmethod
+	def _write_table(table, file_path):
+		'''Write the table to an ECSV file atomically'''
+		temporary_file = file_path.with_name('.%s.%s.tmp' % (file_path.name, os.getpid()))
+		table.write(temporary_file, format = 'ascii.ecsv', overwrite = True)
+		os.replace(temporary_file, file_path)
+
+
+def to_single_precision(map):
+	'''Return the map with the data as float32, the map is returned as is if it is already'''
+	if map.data.dtype == numpy.float32:
+		return map
+	return Map(map.data.astype(numpy.float32), map.meta)
+
+def calibrate_aia_map(map, context = None, single_precision = False):
+	'''Take an AIA map, pass it through the calibration procedures of aiapy and update the map meta
+	If a CalibrationContext is specified, its tables are used instead of fetching them for the map
+	If single_precision is True, the data is kept as float32 after the register, that halves the memory used'''
 	# Calibrate the data and update the metadata
 	# See https://aiapy.readthedocs.io/en/latest/preparing_data.html
 	# We do not apply the PSF correction
-	map = update_pointing(map)
+	map = update_pointing(map, pointing_table = context.pointing_table if context else None)
 	map = fix_observer_location(map)
 	map = register(map)
-	map = correct_degradation(map)
+	# The register always returns float64 data
+	if single_precision:
+		map = to_single_precision(map)
+	map = correct_degradation(map, correction_table = context.correction_table if context else None)
 	map = normalize_exposure(map)
+	# The degradation correction can promote the data back to float64 depending on the numpy version
+	if single_precision:
+		map = to_single_precision(map)
 	map.meta['LVL_NUM'] = 2.0
 	map.meta['DATE'] = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
 	map.meta['PIXLUNIT'] = 'DN/s'
 	
 	# Update data statistics
-	map.meta['DATAMIN'] = numpy.nanmin(map.data)
-	map.meta['DATAMAX'] = numpy.nanmax(map.data)
-	map.meta['DATAMEAN'] = numpy.nanmean(map.data)
-	map.meta['DATARMS'] = numpy.nanstd(map.data)
-	map.meta['DATASKEW'] = scipy.stats.skew(map.data, axis = None, nan_policy = 'omit', bias = True)
-	map.meta['DATAKURT'] = scipy.stats.kurtosis(map.data, axis = None, nan_policy = 'omit', bias = True)
-	map.meta['DATAMEDN'], map.meta['DATAP01'], map.meta['DATAP10'],map.meta['DATAP25'],map.meta['DATAP75'],map.meta['DATAP90'], map.meta['DATAP95'], map.meta['DATAP98'], map.meta['DATAP99'] = numpy.nanpercentile(map.data, [50, 1, 10, 25, 75, 90, 95, 98, 99])
+	# The NaN are removed once, the moments are computed in one pass, and the percentiles in one partition of the same copy of the pixels
+	pixels = map.data[~numpy.isnan(map.data)]
+	pixel_stats = PixelStats(higher_moments = True).update(pixels)
+	map.meta['DATAMIN'] = pixel_stats.min
+	map.meta['DATAMAX'] = pixel_stats.max
+	map.meta['DATAMEAN'] = pixel_stats.mean
+	map.meta['DATARMS'] = pixel_stats.std
+	map.meta['DATASKEW'] = pixel_stats.skewness
+	map.meta['DATAKURT'] = pixel_stats.kurtosis
+	map.meta['DATAMEDN'], map.meta['DATAP01'], map.meta['DATAP10'],map.meta['DATAP25'],map.meta['DATAP75'],map.meta['DATAP90'], map.meta['DATAP95'], map.meta['DATAP98'], map.meta['DATAP99'] = numpy.percentile(pixels, [50, 1, 10, 25, 75, 90, 95, 98, 99], overwrite_input = True)
+	del pixels
 	
 	# The register convert the data to float, so the BLANK keyword is invalid
 	del map.meta['BLANK']
@@ -50,11 +157,27 @@ def calibrate_aia_map(map):
 	
 	return map
 
-def calibrate_aia_fits_file(input_file, output_file, overwrite = False):
-	'''Take a level 1 AIAI FITS file and write the calibrated level 2 FITS file'''
+def calibrate_aia_fits_file(input_file, output_file, overwrite = False, context = None, single_precision = False, quantize_level = None):
+	'''Take a level 1 AIAI FITS file and write the calibrated level 2 FITS file
+	The file is written to a temporary file that is renamed, so an interrupted calibration never leaves a partial output file
+	The quantize_level is passed to the CompImageHDU, that quantizes the float data before compression (by default astropy uses 16)'''
+	output_file = Path(output_file)
+	if not overwrite and output_file.exists():
+		raise FileExistsError('File %s exists already' % output_file)
+	
 	map = Map(input_file)
-	calibrated_map = calibrate_aia_map(map)
-	calibrated_map.save(output_file, overwrite = overwrite, hdu_type = fits.CompImageHDU, checksum = True)
+	calibrated_map = calibrate_aia_map(map, context, single_precision)
+	
+	hdu_type = fits.CompImageHDU if quantize_level is None else partial(fits.CompImageHDU, quantize_level = quantize_level)
+	
+	# The temporary file must have the fits extension for sunpy to know the format
+	temporary_file = output_file.with_name('.%s.%s.tmp.fits' % (output_file.name, os.getpid()))
+	try:
+		calibrated_map.save(str(temporary_file), overwrite = True, hdu_type = hdu_type, checksum = True)
+		os.replace(temporary_file, output_file)
+	finally:
+		if temporary_file.exists():
+			temporary_file.unlink()
 
 # Start point of the script
 if __name__ == '__main__':
@@ -63,6 +186,8 @@ if __name__ == '__main__':
 	parser.add_argument('input', metavar = 'INPUT-FITSFILE', help = 'The path to the level 1 file to calibrate')
 	parser.add_argument('output', metavar = 'OUTPUT-FITSFILE', help = 'The path to the level 2 file to write')
 	parser.add_argument('--overwrite', action = 'store_true', help = 'Overwrite the output file if it already exists')
+	parser.add_argument('--single-precision', action = 'store_true', help = 'Calibrate and write the data as float32 instead of float64')
+	parser.add_argument('--quantize-level', type = float, help = 'The quantize level of the compression of the data (default is 16)')
 	parser.add_argument('--verbose', '-v', choices = ['DEBUG', 'INFO', 'ERROR'], default = 'INFO', help='Set the logging level (default is INFO)')
 	args = parser.parse_args()
 	
@@ -73,4 +198,4 @@ if __name__ == '__main__':
 	# Setup the logging
 	logging.basicConfig(level = getattr(logging, args.verbose), format = '%(asctime)s %(levelname)-8s: %(message)s')
 	
-	calibrate_aia_fits_file(args.input, args.output, overwrite = args.overwrite)
+	calibrate_aia_fits_file(args.input, args.output, overwrite = args.overwrite, single_precision = args.single_precision, quantize_level = args.quantize_level)
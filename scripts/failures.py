@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+import os
+import json
+import time
+import errno
+import random
+import sqlite3
+import logging
+import argparse
+import threading
+from datetime import datetime, timezone
+
+from job import JobError
+
+__all__ = ['is_transient_error', 'Retrying', 'DeadLetterList']
+
+# Error numbers of the OS errors that can disappear when retried, e.g. on a network file system
+TRANSIENT_ERRNOS = {errno.EIO, errno.EAGAIN, errno.EBUSY, errno.EINTR, errno.ESTALE, errno.ETIMEDOUT, errno.ENOLCK, errno.ECONNRESET, errno.ECONNREFUSED, errno.EHOSTUNREACH, errno.ENETUNREACH}
+
+def is_transient_error(error):
+	'''Return True if the error can disappear when the operation is retried, False if it will probably happen again (e.g. a corrupt file)'''
+	
+	if isinstance(error, JobError):
+		# An executable killed after a timeout is probably stuck (e.g. on a corrupt file), and would take the whole timeout again
+		if error.extra.get('timeout') is not None:
+			return False
+		# An executable killed by a signal, e.g. when out of memory, can succeed the next time, but not one that failed by itself
+		return error.exit_code is not None and error.exit_code < 0
+	
+	if isinstance(error, (TimeoutError, ConnectionError)):
+		return True
+	
+	if isinstance(error, OSError):
+		return error.errno in TRANSIENT_ERRNOS
+	
+	if isinstance(error, sqlite3.OperationalError):
+		return 'locked' in str(error)
+	
+	return False
+
+
+class Retrying:
+	'''Wrapper of a function that calls it again when it raises a transient error, at most retries times
+	The wait before the n-th retry is backoff * 2**(n-1) seconds, increased by a random jitter of up to 50%, so that parallel workers do not retry at the same time
+	The wrapper can be pickled, so it can be used with a process pool'''
+	
+	# Default wait in seconds before the first retry
+	BACKOFF = 5
+	
+	def __init__(self, function, retries = 0, backoff = None):
+		self.function = function
+		self.retries = retries
+		self.backoff = self.BACKOFF if backoff is None else backoff
+	
+	def __call__(self, *args, **kwargs):
+		attempt = 0
+		while True:
+			try:
+				return self.function(*args, **kwargs)
+			except Exception as why:
+				if attempt >= self.retries or not is_transient_error(why):
+					raise
+				delay = self.backoff * 2**attempt * (1 + random.random() / 2)
+				attempt += 1
+				logging.warning('Transient error: %s; Retrying in %.1f seconds (retry %s of %s)', why, delay, attempt, self.retries)
+				time.sleep(delay)
+
+
+class DeadLetterList:
+	'''Persistent list of the items that failed, with their last error, stored in a JSON file
+	An item is identified by a string key (e.g. the date), and is removed from the list when it is processed successfully'''
+	
+	def __init__(self, file_path):
+		self.file_path = file_path
+		self._lock = threading.Lock()
+		self._entries = dict()
+		if os.path.exists(file_path):
+			with open(file_path, 'rt') as file:
+				self._entries = json.load(file)
+	
+	@property
+	def keys(self):
+		'''The sorted keys of the items that failed'''
+		with self._lock:
+			return sorted(self._entries)
+	
+	def get_entry(self, key):
+		'''Return the entry of the item, a dict with the error, if it is transient, the number of failures and the time of the last failure, or None'''
+		with self._lock:
+			return self._entries.get(key)
+	
+	def add(self, key, error):
+		'''Add or update the entry of an item that failed'''
+		with self._lock:
+			failures = self._entries[key]['failures'] if key in self._entries else 0
+			self._entries[key] = {
+				'error': str(error),
+				'transient': is_transient_error(error),
+				'failures': failures + 1,
+				'time': datetime.now(timezone.utc).isoformat()
+			}
+			self._save()
+	
+	def remove(self, key):
+		'''Remove the entry of an item that succeeded'''
+		with self._lock:
+			if key in self._entries:
+				del self._entries[key]
+				self._save()
+	
+	def _save(self):
+		'''Write the entries to the file atomically, must be called with the lock held'''
+		temporary_file = '%s.%s.tmp' % (self.file_path, os.getpid())
+		with open(temporary_file, 'wt') as file:
+			json.dump(self._entries, file, indent = 2, sort_keys = True)
+		os.replace(temporary_file, self.file_path)
+
+
+# Start point of the script
+if __name__ == '__main__':
+	
+	parser = argparse.ArgumentParser(description='Print the items of a dead letter list')
+	parser.add_argument('file_path', metavar = 'DEAD-LETTER-FILE', help = 'The path to the JSON dead letter file')
+	
+	args = parser.parse_args()
+	
+	dead_letter_list = DeadLetterList(args.file_path)
+	
+	for key in dead_letter_list.keys:
+		entry = dead_letter_list.get_entry(key)
+		print('%s: %s failures, last at %s (%s): %s' % (key, entry['failures'], entry['time'], 'transient' if entry['transient'] else 'permanent', entry['error'].replace('\n', ' ')))
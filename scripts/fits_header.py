@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+import gzip
+import logging
+import argparse
+from astropy.io import fits
+
+__all__ = ['read_header_keywords', 'read_files_header_keywords']
+
+# Size in bytes of a FITS block and of a header card
+BLOCK_SIZE = 2880
+CARD_SIZE = 80
+
+# Magic number of gzip files
+GZIP_MAGIC = b'\x1f\x8b'
+
+def read_header_keywords(file_path, keywords, hdu = 0):
+	'''Return a dict with the values of the keywords in the header of the HDU of a FITS file
+	Only the header blocks up to the END card of the HDU are read, the data of the previous HDUs is skipped, and no data is decompressed
+	Keywords that are not in the header are missing from the dict'''
+	
+	with open(file_path, 'rb') as file:
+		if file.read(2) == GZIP_MAGIC:
+			file = gzip.open(file_path, 'rb')
+		else:
+			file.seek(0)
+		
+		with file:
+			for hdu_number in range(hdu):
+				# For the previous HDUs, only the keywords that give the size of the data are needed
+				values = _read_header(file, lambda keyword: keyword in ('BITPIX', 'PCOUNT', 'GCOUNT') or keyword.startswith('NAXIS'))
+				file.seek(_get_data_size(values), 1)
+			
+			keywords = set(keywords)
+			return _read_header(file, lambda keyword: keyword in keywords)
+
+
+def read_files_header_keywords(file_paths, keywords, hdu = 0):
+	'''Return a dict of file path to a dict with the values of the keywords in the header of the HDU of the FITS files
+	Files that cannot be read are logged and their value is None'''
+	
+	files_values = dict()
+	
+	for file_path in file_paths:
+		try:
+			files_values[file_path] = read_header_keywords(file_path, keywords, hdu)
+		except Exception as why:
+			logging.error('Could not read header of file %s: %s', file_path, why)
+			files_values[file_path] = None
+	
+	return files_values
+
+
+def _read_header(file, is_wanted):
+	'''Read a header from the current position of the file up to the end of the block containing the END card, and return the values of the wanted keywords'''
+	
+	values = dict()
+	
+	while True:
+		block = file.read(BLOCK_SIZE)
+		
+		if len(block) < BLOCK_SIZE:
+			raise ValueError('Unexpected end of file while reading header')
+		
+		for start in range(0, BLOCK_SIZE, CARD_SIZE):
+			card = block[start:start + CARD_SIZE]
+			keyword = card[:8].rstrip().decode('ascii')
+			
+			if keyword == 'END':
+				return values
+			
+			# Only cards with a value indicator have a value
+			if card[8:10] == b'= ' and is_wanted(keyword):
+				values[keyword] = fits.Card.fromstring(card.decode('ascii')).value
+
+
+def _get_data_size(values):
+	'''Return the size in bytes of the data following a header, including the padding to a full block'''
+	
+	naxis = values.get('NAXIS', 0)
+	
+	if naxis == 0:
+		return 0
+	
+	size = 1
+	for axis in range(1, naxis + 1):
+		size *= values['NAXIS%d' % axis]
+	
+	size = abs(values['BITPIX']) // 8 * values.get('GCOUNT', 1) * (values.get('PCOUNT', 0) + size)
+	
+	return (size + BLOCK_SIZE - 1) // BLOCK_SIZE * BLOCK_SIZE
+
+
+# Start point of the script
+if __name__ == '__main__':
+	
+	parser = argparse.ArgumentParser(description='Prints the value of keywords of FITS files without reading the data')
+	parser.add_argument('files', metavar = 'FITSFILE', nargs = '+', help = 'The path to a FITS file')
+	parser.add_argument('--keyword', '-k', dest = 'keywords', metavar = 'KEYWORD', action = 'append', required = True, help = 'The name of a keyword; Can be specified multiple times')
+	parser.add_argument('--hdu', '-H', default = 0, type = int, help = 'The HDU number that contains the keywords')
+	
+	args = parser.parse_args()
+	
+	for file_path, values in read_files_header_keywords(args.files, args.keywords, args.hdu).items():
+		if values is not None:
+			print(file_path, ' '.join('%s=%s' % (keyword, values.get(keyword)) for keyword in args.keywords))
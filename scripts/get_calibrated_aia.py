@@ -6,9 +6,13 @@ import argparse
 import warnings
 from datetime import datetime, timedelta
 from pathlib import Path
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
 
-from aia_calibration import calibrate_aia_fits_file
+from aia_calibration import CalibrationContext, calibrate_aia_fits_file
 from sdo_data import SdoData
+from parallel import imap_unordered
+from failures import Retrying, DeadLetterList
 
 # Pattern that accepts a date and wavelength of where the AIA FITS files are located
 INPUT_FILE_PATTERN = '/data/SDO/AIA_HMI_1h_synoptic/aia.lev1/{wavelength:04d}/{date.year:04d}/{date.month:02d}/{date.day:02d}/AIA.{date.year:04d}{date.month:02d}{date.day:02d}_{date.hour:02d}*.{wavelength:04d}.*.fits'
@@ -21,56 +25,154 @@ def date_range(start, end, step):
 		yield date
 		date += step
 
+# The calibration tables used by the process, set by setup_worker
+CALIBRATION_CONTEXT = None
+
+def setup_worker(log_level, log_format, calibration_context):
+	'''Setup the logging and the calibration tables of a process, so that they are loaded once per process and not for every file'''
+	global CALIBRATION_CONTEXT
+	# Turn off the many warnings from sunpy and scipy
+	if log_level != logging.DEBUG:
+		warnings.filterwarnings("ignore")
+	logging.basicConfig(level = log_level, format = log_format)
+	CALIBRATION_CONTEXT = calibration_context
+
+def calibrate_file(files, **options):
+	'''Write the calibrated file for a tuple (input file, output file), the options are passed to calibrate_aia_fits_file'''
+	input_file, output_file = files
+	logging.info('Calibrating file %s', input_file)
+	calibrate_aia_fits_file(input_file, output_file, context = CALIBRATION_CONTEXT, **options)
+
 # Start point of the script
 if __name__ == '__main__':
 	
 	parser = argparse.ArgumentParser(description='Write the calibrated AIA FITS files')
 	parser.add_argument('--verbose', '-v', choices = ['DEBUG', 'INFO', 'ERROR'], default = 'INFO', help='Set the logging level (default is INFO)')
-	parser.add_argument('--start-date', '-s', required = True, type = datetime.fromisoformat, help = 'Start date of AIA files (ISO 8601 format)')
-	parser.add_argument('--end-date', '-e', default = datetime.utcnow(), type = datetime.fromisoformat, help = 'End date of AIA files (ISO 8601 format)')
+	parser.add_argument('--start-date', '-s', type = datetime.fromisoformat, help = 'Start date of AIA files (ISO 8601 format), required unless --retry-failed is set')
+	parser.add_argument('--end-date', '-e', type = datetime.fromisoformat, help = 'End date of AIA files (ISO 8601 format, default is now)')
 	parser.add_argument('--interval', '-i', default = 6, type = int, help = 'Number of hours between two files')
 	parser.add_argument('--wavelength', '-w', default = [171, 193], nargs = '+', type = int, help = 'The AIA wavelengths to process')
 	parser.add_argument('--overwrite', action = 'store_true', help = 'Overwrite the output file if it already exists')
+	parser.add_argument('--single-precision', action = 'store_true', help = 'Calibrate and write the data as float32 instead of float64')
+	parser.add_argument('--quantize-level', type = float, help = 'The quantize level of the compression of the data (default is 16)')
 	parser.add_argument('--output-dir', '-o', default = '.', type = Path, help = 'The directory where to write the files')
+	parser.add_argument('--index-file', '-X', metavar = 'INDEX-FILE', help = 'The path to a SQLite file to keep an index of the AIA files and their quality')
+	parser.add_argument('--quality-workers', '-W', type = int, help = 'The number of threads to check the quality of the AIA files concurrently')
+	parser.add_argument('--workers', '-j', default = 1, type = int, help = 'Number of files to calibrate in parallel in separate processes (default is 1)')
+	parser.add_argument('--calibration-cache', '-C', metavar = 'CACHE-DIRECTORY', type = Path, help = 'The directory where to keep the pointing and degradation tables, so that later runs can work offline')
+	parser.add_argument('--retries', '-r', default = 0, type = int, help = 'Number of times to retry a file that failed with a transient error, e.g. of the file system (default is 0)')
+	parser.add_argument('--dead-letter', '-d', metavar = 'DEAD-LETTER-FILE', help = 'Path to a JSON file to record the files that failed')
+	parser.add_argument('--retry-failed', action = 'store_true', help = 'Process only the files recorded in the dead letter file, instead of the files from start date to end date')
 	
 	args = parser.parse_args()
 	
+	if args.retry_failed and not args.dead_letter:
+		parser.error('--retry-failed requires --dead-letter')
+	elif args.start_date is None and not args.retry_failed:
+		parser.error('--start-date is required unless --retry-failed is set')
+	
 	# Turn off the many warnings from sunpy and scipy
 	if args.verbose != 'DEBUG':
 		warnings.filterwarnings("ignore")
 	
 	# Setup the logging
-	logging.basicConfig(level = getattr(logging, args.verbose), format = '%(asctime)s %(levelname)-8s: %(message)s')
+	log_level = getattr(logging, args.verbose)
+	log_format = '%(asctime)s %(processName)-18s %(levelname)-8s: %(message)s' if args.workers > 1 else '%(asctime)s %(levelname)-8s: %(message)s'
+	logging.basicConfig(level = log_level, format = log_format)
 	
 	sdo_data = SdoData(
 		aia_file_pattern = INPUT_FILE_PATTERN,
-		ignore_quality_bits = []
+		ignore_quality_bits = [],
+		index_file = args.index_file,
+		quality_workers = args.quality_workers
 	)
 	
 	if not args.output_dir.is_dir():
 		logging.critical('%s is not a directory', args.output_dir)
 		sys.exit(2)
 	
-	for date in date_range(args.start_date, args.end_date, timedelta(hours=args.interval)):
-		for wavelength in args.wavelength:
+	dead_letter_list = DeadLetterList(args.dead_letter) if args.dead_letter else None
+	
+	# The files are identified by their date and wavelength
+	if args.retry_failed:
+		failed_keys = set(dead_letter_list.keys)
+		if not failed_keys:
+			logging.info('No failed file to process in %s', args.dead_letter)
+			sys.exit(0)
+		failed_files = [key.rsplit(' ', 1) for key in failed_keys]
+		dates = sorted(set(datetime.fromisoformat(date) for date, wavelength in failed_files))
+		wavelengths = sorted(set(int(wavelength) for date, wavelength in failed_files))
+		start_date, end_date = dates[0], dates[-1] + timedelta(hours=args.interval)
+	else:
+		start_date, end_date = args.start_date, args.end_date or datetime.utcnow()
+		dates = list(date_range(start_date, end_date, timedelta(hours=args.interval)))
+		wavelengths = args.wavelength
+	
+	# Find all the AIA files at once, listing each directory only once
+	input_files = sdo_data.scan(dates, wavelengths)
+	
+	# Fetch the calibration tables once for all the dates
+	try:
+		calibration_context = CalibrationContext.load(start_date, end_date, args.calibration_cache)
+	except Exception as why:
+		logging.critical('Could not load the calibration tables: %s', why)
+		sys.exit(1)
+	
+	# The workers are setup the same way as the main process
+	setup_worker(log_level, log_format, calibration_context)
+	
+	# Select the files to calibrate before starting the workers
+	calibration_files = list()
+	file_keys = dict()
+	
+	for date in dates:
+		for wavelength in wavelengths:
 			
-			input_file = sdo_data.get_AIA_file(date, wavelength)
+			key = '%s %04d' % (date.isoformat(), wavelength)
+			
+			if args.retry_failed and key not in failed_keys:
+				continue
+			
+			input_file = input_files[(date, wavelength)]
 			
 			if input_file is None:
-				logging.info('No AIA file found for date %s and wavelength %s, skipping!', date, wavelength)
+				why = sdo_data.get_AIA_file_error(date, wavelength)
+				if why is None:
+					logging.info('No AIA file found for date %s and wavelength %s, skipping!', date, wavelength)
+				else:
+					# A file that could not be read is failed, instead of skipped as missing
+					logging.error('Could not read AIA file for date %s and wavelength %s: %s', date, wavelength, why)
+					if dead_letter_list is not None:
+						dead_letter_list.add(key, why)
 				continue
 			
 			output_directory = args.output_dir / OUTPUT_FILE_PATTERN.format(date = date, wavelength = wavelength)
 			output_directory.mkdir(parents = True, exist_ok = True)
 			output_file = output_directory / (Path(input_file).name.rsplit('.', 2)[0] + '.image_lev2.fits')
 			
+			# The output file is written atomically, so if it exists the file was calibrated successfully
 			if not args.overwrite and output_file.exists():
 				logging.info('File %s exists already, skipping!', output_file)
+				if dead_letter_list is not None:
+					dead_letter_list.remove(key)
 				continue
 			
-			try:
-				calibrate_aia_fits_file(input_file, str(output_file), overwrite = args.overwrite)
-			except Exception as why:
-				logging.error('Could not write calibrated file for file %s: %s', input_file, why)
-			else:
-				logging.info('Wrote calibrated file %s', output_file)
+			calibration_files.append((input_file, str(output_file)))
+			file_keys[input_file] = key
+	
+	# Each worker process calibrates one file at a time, so at most one image per worker is in memory
+	# A failed file does not stop the calibration of the other files, it is recorded in the dead letter list to be retried later
+	calibrate = Retrying(partial(calibrate_file, overwrite = args.overwrite, single_precision = args.single_precision, quantize_level = args.quantize_level), args.retries)
+	
+	for (input_file, output_file), result, why in imap_unordered(calibrate, calibration_files, workers = args.workers, executor_class = ProcessPoolExecutor, initializer = setup_worker, initargs = (log_level, log_format, calibration_context)):
+		if why is not None:
+			logging.error('Could not write calibrated file for file %s: %s', input_file, why)
+			if dead_letter_list is not None:
+				dead_letter_list.add(file_keys[input_file], why)
+		else:
+			logging.info('Wrote calibrated file %s', output_file)
+			if dead_letter_list is not None:
+				dead_letter_list.remove(file_keys[input_file])
+	
+	if dead_letter_list is not None and dead_letter_list.keys:
+		logging.warning('%s files failed, they can be processed again with --retry-failed --dead-letter %s', len(dead_letter_list.keys), args.dead_letter)
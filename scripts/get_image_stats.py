@@ -1,13 +1,21 @@
 #!/usr/bin/env python3
+import sys
 import logging
 import argparse
-import numpy
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
 from configparser import ConfigParser
 from datetime import datetime, timedelta
-from pathlib import Path
 from astropy.io import fits
 
 from sdo_data import SdoData
+from pixel_stats import SplitStats
+from solar_disk import SolarDiskMasks
+from parallel import imap_unordered
+from stats_store import get_stats_store
+from manifest import Manifest, get_fingerprint
+from failures import Retrying, DeadLetterList
+from watch import DateWatcher
 
 def date_range(start, end, step):
 	'''Equivalent to range for date'''
@@ -17,67 +25,102 @@ def date_range(start, end, step):
 		date += step
 
 
-def get_pixels_stats(pixels, prefix = ''):
-	'''Return a dict of various statistics about pixel values'''
+# Cache of the solar disk masks, shared by all the images
+DISK_MASKS = SolarDiskMasks()
+
+# Keys and values of the percentiles in the statistics
+PERCENTILES = {'P01': 1, 'P10': 10, 'P25': 25, 'MEDN': 50, 'P75': 75, 'P90': 90, 'P95': 95, 'P98': 98, 'P99': 99}
+
+
+def get_stats_dict(pixel_stats, percentiles, prefix = ''):
+	'''Return a dict of various statistics from a PixelStats and the values of the PERCENTILES'''
 	stats = dict()
 	
-	# Remove the nan from the pixels
-	pixels = numpy.ma.masked_invalid(pixels).compressed()
+	stats[prefix + 'MIN'] = float(pixel_stats.min)
+	stats[prefix + 'MAX'] = float(pixel_stats.max)
+	stats[prefix + 'MEAN'] = float(pixel_stats.mean)
+	stats[prefix + 'RMS'] = float(pixel_stats.std)
+	stats[prefix + 'TOTL'] = float(pixel_stats.sum)
 	
-	stats[prefix + 'MIN'] = '%.3f' % numpy.min(pixels)
-	stats[prefix + 'MAX'] = '%.3f' % numpy.max(pixels)
-	stats[prefix + 'MEAN'] = '%.3f' % numpy.mean(pixels)
-	stats[prefix + 'RMS'] = '%.3f' % numpy.std(pixels)
-	stats[prefix + 'TOTL'] = '%.3f' % numpy.sum(pixels)
-	
-	# Compute all percentiles at once
-	keys = ['P01', 'P10', 'P25', 'MEDN', 'P75', 'P90', 'P95', 'P98', 'P99']
-	percentiles = numpy.percentile(pixels, [1,10,25,50,75,90,95,98,99], overwrite_input = True)
-	for key, percentile in zip(keys, percentiles):
-		stats[prefix + key] = '%.3f' % percentile
+	for key, percentile in zip(PERCENTILES.keys(), percentiles):
+		stats[prefix + key] = float(percentile)
 	
 	return stats
 
 
-def get_image_stats(filepath, hdu):
-	'''Return a dict of various info and statistics about the image'''
+def get_image_stats(filepath, hdu, disk_masks = None, band_size = None, percentile_engine = 'exact', percentile_accuracy = None):
+	'''Return a dict of various info and statistics about the image
+	If band_size is specified, the image is read and reduced by bands of band_size rows instead of being loaded at once, the memory usage is bounded only with the sketch engine, as the exact engine gathers the finite pixels of the whole image
+	The percentile_engine can be 'exact', or 'sketch' to estimate the percentiles within a relative error of percentile_accuracy in fixed memory'''
 	
 	stats = dict()
 	
-	# Get the image and header from the FITS file
+	# Get the header and the image from the FITS file
 	with fits.open(filepath) as hdus:
 		header = hdus[hdu].header
-		image = hdus[hdu].data
-	
-	stats['DATE_OBS'] = header['T_OBS']
-	stats['WAVELENGTH'] = header['WAVELNTH']
-	
-	# Normalise the image by the exposure time
-	exposure_time = float(header['EXPTIME'])
-	image /= exposure_time
-	
-	# Retrieve the statistics about the whole image
-	stats.update(get_pixels_stats(image, prefix = 'DATA'))
+		shape = hdus[hdu].shape
+		
+		stats['DATE_OBS'] = header['T_OBS']
+		stats['WAVELENGTH'] = header['WAVELNTH']
+		
+		# Select the pixels for the statistics about the solar disk
+		# As the legacy code computed them from masked_less_equal(x*x+y*y, solar_radius * solar_radius),
+		# the DISK statistics are about the pixels for which x*x+y*y > solar_radius * solar_radius
+		# where x is the distance to shape[0] - center_x along the rows and y the distance to center_y along the columns
+		solar_radius = header['RSUN_OBS'] / header['CDELT1']
+		center_x = header['CRPIX1'] - 1
+		center_y = header['CRPIX2'] - 1
+		disk_geometry = (shape, shape[0] - center_x, center_y, solar_radius)
+		disk_masks = disk_masks or DISK_MASKS
+		
+		# The image is normalised by the exposure time
+		exposure_time = float(header['EXPTIME'])
+		
+		# Retrieve the statistics about the whole image and the solar disk in one go
+		# The mask of the pixels outside of the disk is built from the row ranges of the disk only for the rows being reduced
+		split_stats = SplitStats(shape[0] * shape[1], percentile_engine, percentile_accuracy)
+		
+		if band_size is None:
+			image = hdus[hdu].data
+			image /= exposure_time
+			split_stats.update(image, disk_masks.get_mask(*disk_geometry, outside = True))
+		else:
+			# The section of an uncompressed image is read from the memory map, and for a compressed image only the tiles of the band are decompressed
+			section = hdus[hdu].section
+			for start in range(0, shape[0], band_size):
+				band = section[start:start + band_size] / exposure_time
+				split_stats.update(band, disk_masks.get_mask(*disk_geometry, rows = slice(start, start + band_size), outside = True))
 	
-	# Retrieve the statistics about the solar disk
-	# We make the list of pixels on the solar disk
-	solar_radius = header['RSUN_OBS'] / header['CDELT1']
-	center_x = header['CRPIX1'] - 1
-	center_y = header['CRPIX2'] - 1
-	x, y = numpy.mgrid[image.shape[0] - center_x : - center_x : -1, - center_y : image.shape[1] - center_y : 1]
-	disk_mask = numpy.ma.masked_less_equal(x*x+y*y, solar_radius * solar_radius)
-	disk_image = numpy.ma.masked_array(image, disk_mask.mask)
-	stats.update(get_pixels_stats(disk_image, prefix = 'DISK'))
+	(image_stats, image_percentiles), (disk_stats, disk_percentiles) = split_stats.get_results(list(PERCENTILES.values()))
+	stats.update(get_stats_dict(image_stats, image_percentiles, prefix = 'DATA'))
+	stats.update(get_stats_dict(disk_stats, disk_percentiles, prefix = 'DISK'))
 	
 	return stats
 
 
-def write_image_stats(filepath, stats):
-	'''Write a csv file with a dict of stats (legacy code)'''
-	headers = sorted(stats.keys())
-	with open(filepath, 'tw') as file:
-		file.write(','.join(headers) + '\n')
-		file.write(','.join([str(stats[header]) for header in headers]) + '\n')
+def process_image(image, hdu, **options):
+	'''Return the statistics of an image (key, path), the options are passed to get_image_stats'''
+	
+	key, aia_image = image
+	logging.info('Computing statistics for image %s', aia_image)
+	return get_image_stats(aia_image, hdu, **options)
+
+
+def setup_worker(log_level, log_format, disk_mask_decimals):
+	'''Setup the logging and the cache of the solar disk masks of a process'''
+	global DISK_MASKS
+	logging.basicConfig(level = log_level, format = log_format)
+	DISK_MASKS = SolarDiskMasks(decimals = disk_mask_decimals)
+
+
+def record_images(images, manifest = None, image_fingerprints = None, dead_letter_list = None):
+	'''Record the images (key, output file) in the manifest, remove them from the dead letter list, and empty the list'''
+	for key, output_file in images:
+		if manifest is not None:
+			manifest.record('IMAGE_STATS', key, image_fingerprints[key], [output_file])
+		if dead_letter_list is not None:
+			dead_letter_list.remove(key)
+	images.clear()
 
 
 if __name__ == '__main__':
@@ -86,14 +129,31 @@ if __name__ == '__main__':
 	parser = argparse.ArgumentParser(description='Compute images statistics from AIA FITS files for the STAFF viewer')
 	parser.add_argument('--verbose', '-v', choices = ['DEBUG', 'INFO', 'ERROR'], default = 'INFO', help='Set the logging level (default is INFO)')
 	parser.add_argument('--config-file', '-c', required = True, help = 'Path to the config file of the script')
-	parser.add_argument('--start-date', '-s', required = True, type = datetime.fromisoformat, help = 'Start date of AIA files (ISO 8601 format)')
-	parser.add_argument('--end-date', '-e', default = datetime.utcnow(), type = datetime.fromisoformat, help = 'End date of AIA files (ISO 8601 format)')
+	parser.add_argument('--start-date', '-s', type = datetime.fromisoformat, help = 'Start date of AIA files (ISO 8601 format), required unless --retry-failed or --watch is set (default in watch mode is the start of the current day)')
+	parser.add_argument('--end-date', '-e', type = datetime.fromisoformat, help = 'End date of AIA files (ISO 8601 format, default is now, or never in watch mode)')
 	parser.add_argument('--interval', '-i', default = 6, type = int, help = 'Number of hours between two results')
+	parser.add_argument('--workers', '-w', default = 1, type = int, help = 'Number of images to process in parallel in separate processes (default is 1)')
+	parser.add_argument('--manifest', '-m', metavar = 'MANIFEST-FILE', help = 'Path to a SQLite file to record the processed images, so that images already processed with the same parameters are skipped')
+	parser.add_argument('--retries', '-r', default = 0, type = int, help = 'Number of times to retry an image that failed with a transient error, e.g. of the file system (default is 0)')
+	parser.add_argument('--dead-letter', '-d', metavar = 'DEAD-LETTER-FILE', help = 'Path to a JSON file to record the images that failed')
+	parser.add_argument('--retry-failed', action = 'store_true', help = 'Process only the images recorded in the dead letter file, instead of the images from start date to end date')
+	parser.add_argument('--watch', action = 'store_true', help = 'Keep running and process the images of each date as soon as they are available')
+	parser.add_argument('--poll-interval', default = 60, type = float, help = 'Number of seconds between two searches of the AIA files in watch mode (default is 60)')
+	parser.add_argument('--grace-period', default = 3600, type = float, help = 'Number of seconds to wait for the missing AIA files of a date in watch mode, once its first file is found (default is 3600)')
 	
 	args = parser.parse_args()
 	
+	if args.retry_failed and not args.dead_letter:
+		parser.error('--retry-failed requires --dead-letter')
+	elif args.retry_failed and args.watch:
+		parser.error('--retry-failed and --watch cannot be used together')
+	elif args.start_date is None and not args.retry_failed and not args.watch:
+		parser.error('--start-date is required unless --retry-failed or --watch is set')
+	
 	# Setup the logging
-	logging.basicConfig(level = getattr(logging, args.verbose), format = '%(asctime)s %(levelname)-8s: %(message)s')
+	log_level = getattr(logging, args.verbose)
+	log_format = '%(asctime)s %(processName)-18s %(levelname)-8s: %(message)s' if args.workers > 1 else '%(asctime)s %(levelname)-8s: %(message)s'
+	logging.basicConfig(level = log_level, format = log_format)
 	
 	# Parse the script config file
 	# To allow parsing list of wavelengths or quality bits
@@ -105,32 +165,113 @@ if __name__ == '__main__':
 	sdo_data = SdoData(
 		aia_file_pattern = config.get('SDO_DATA', 'aia_file_pattern'),
 		ignore_quality_bits = config.getintlist('SDO_DATA', 'ignore_quality_bits'),
-		hdu = config.getint('SDO_DATA', 'hdu')
+		hdu = config.getint('SDO_DATA', 'hdu'),
+		index_file = config.get('SDO_DATA', 'index_file', fallback = None),
+		quality_workers = config.getint('SDO_DATA', 'quality_workers', fallback = None)
 	)
 	
 	hdu = config.getint('IMAGE_STATS', 'hdu')
-	output_directory = Path(config.get('IMAGE_STATS', 'output_directory'))
+	output_format = config.get('IMAGE_STATS', 'output_format', fallback = 'csv')
+	output_directory = config.get('IMAGE_STATS', 'output_directory')
+	try:
+		stats_store = get_stats_store(output_format, output_directory)
+	except (ValueError, ImportError) as why:
+		logging.critical('Could not create the %s statistics store: %s', output_format, why)
+		sys.exit(2)
+	disk_mask_decimals = config.getint('IMAGE_STATS', 'disk_mask_decimals', fallback = None)
+	options = {
+		'band_size': config.getint('IMAGE_STATS', 'band_size', fallback = None),
+		'percentile_engine': config.get('IMAGE_STATS', 'percentile_engine', fallback = 'exact'),
+		'percentile_accuracy': config.getfloat('IMAGE_STATS', 'percentile_accuracy', fallback = None)
+	}
 	
-	for date in date_range(args.start_date, args.end_date, timedelta(hours=args.interval)):
+	# The records are kept per config file, so that the runs of the quicklook and science data can share the manifest
+	manifest = Manifest(args.manifest, args.config_file) if args.manifest else None
+	
+	dead_letter_list = DeadLetterList(args.dead_letter) if args.dead_letter else None
+	
+	# The workers are setup the same way as the main process
+	setup_worker(log_level, log_format, disk_mask_decimals)
+	
+	# The images are identified by their date and wavelength, so that the statistics are computed again if a better file is found
+	# The dates are processed in batches, in watch mode a batch is the dates whose AIA files became available
+	if args.retry_failed:
+		failed_keys = set(dead_letter_list.keys)
+		failed_images = [key.rsplit(' ', 1) for key in failed_keys]
+		wavelengths = sorted(set(int(wavelength) for date, wavelength in failed_images))
+		batches = [sorted(set(datetime.fromisoformat(date) for date, wavelength in failed_images))]
+	elif args.watch:
+		wavelengths = config.getintlist('IMAGE_STATS', 'wavelengths')
+		start_date = args.start_date or datetime.utcnow().replace(hour = 0, minute = 0, second = 0, microsecond = 0)
+		watcher = DateWatcher(sdo_data, wavelengths, start_date, timedelta(hours=args.interval), timedelta(seconds=args.grace_period), args.end_date)
+		batches = watcher.watch(args.poll_interval)
+	else:
+		wavelengths = config.getintlist('IMAGE_STATS', 'wavelengths')
+		batches = [list(date_range(args.start_date, args.end_date or datetime.utcnow(), timedelta(hours=args.interval)))]
+	
+	# Each worker process loads one image at a time, so at most one image per worker is in memory
+	# A failed image does not stop the processing of the other images, it is recorded in the dead letter list to be retried later
+	process = Retrying(partial(process_image, hdu = hdu, **options), args.retries)
+	
+	for dates in batches:
+		
+		# Find all the AIA files at once, listing each directory only once
+		aia_files = sdo_data.scan(dates, wavelengths)
+		
+		# Get the aia images with their key, if some are missing (== None), just ignore them
+		# The same file can be found for several dates, so the images are identified by their key and not by their path
+		images = [('%s %04d' % (date.isoformat(), wavelength), aia_files[(date, wavelength)]) for date in dates for wavelength in wavelengths if aia_files[(date, wavelength)]]
+		
+		# The images that could not be read are failed, instead of ignored as missing
+		unreadable_images = [('%s %04d' % (date.isoformat(), wavelength), sdo_data.get_AIA_file_error(date, wavelength)) for date in dates for wavelength in wavelengths if sdo_data.get_AIA_file_error(date, wavelength) is not None]
+		
+		if args.retry_failed:
+			images = [(key, aia_image) for key, aia_image in images if key in failed_keys]
+			unreadable_images = [(key, why) for key, why in unreadable_images if key in failed_keys]
 		
-		# Get the aia images, if some are missing (== None), just ignore them
-		# Compute the statistics and write them as csv
-		aia_images = [sdo_data.get_AIA_file(date, wavelength) for wavelength in config.getintlist('IMAGE_STATS', 'wavelengths')]
+		for key, why in unreadable_images:
+			logging.error('Error reading image %s: %s', key, why)
+			if dead_letter_list is not None:
+				dead_letter_list.add(key, why)
 		
-		for aia_image in filter(bool, aia_images):
+		# Skip the images whose statistics were already computed with the same parameters
+		image_fingerprints = None
+		if manifest is not None:
+			parameters = {'hdu': hdu, 'output_format': output_format, 'output_directory': output_directory, 'disk_mask_decimals': disk_mask_decimals, **options}
+			image_fingerprints = {key: get_fingerprint([aia_image], parameters) for key, aia_image in images}
 			
-			logging.info('Computing statistics for image %s', aia_image)
-			try:
-				image_stats = get_image_stats(aia_image, hdu)
-			except Exception as why:
+			completed_keys = set(key for key, aia_image in images if manifest.is_complete('IMAGE_STATS', key, image_fingerprints[key]))
+			if completed_keys:
+				logging.info('Statistics of %s images are up to date, skipping them!', len(completed_keys))
+				images = [(key, aia_image) for key, aia_image in images if key not in completed_keys]
+		
+		# The images are recorded in the manifest and removed from the dead letter list only once their statistics are written by the store
+		unrecorded_images = list()
+		
+		# Compute the statistics and write them to the store
+		for (key, aia_image), image_stats, why in imap_unordered(process, images, workers = args.workers, executor_class = ProcessPoolExecutor, initializer = setup_worker, initargs = (log_level, log_format, disk_mask_decimals)):
+			if why is not None:
 				logging.error('Error computing statistics for image %s: %s', aia_image, why)
+				if dead_letter_list is not None:
+					dead_letter_list.add(key, why)
 				continue
 			
-			csv_file = output_directory / Path(aia_image).with_suffix('.csv').name
-			
-			logging.info('Writing statistics for image %s to file %s', aia_image, csv_file)
+			logging.info('Writing statistics for image %s to %s', aia_image, stats_store.directory)
 			try:
-				image_stats = write_image_stats(csv_file, image_stats)
+				stats_store.append(aia_image, image_stats)
 			except Exception as why:
-				logging.error('Error writing statistics for image %s to file %s: %s', aia_image, csv_file, why)
+				logging.error('Error writing statistics for image %s to %s: %s', aia_image, stats_store.directory, why)
+				if dead_letter_list is not None:
+					dead_letter_list.add(key, why)
 				continue
+			
+			unrecorded_images.append((key, stats_store.get_output_file(aia_image, image_stats)))
+			if stats_store.pending_count == 0:
+				record_images(unrecorded_images, manifest, image_fingerprints, dead_letter_list)
+		
+		stats_store.close()
+		
+		record_images(unrecorded_images, manifest, image_fingerprints, dead_letter_list)
+		
+		if dead_letter_list is not None and dead_letter_list.keys:
+			logging.warning('%s images failed, they can be processed again with --retry-failed --dead-letter %s', len(dead_letter_list.keys), args.dead_letter)
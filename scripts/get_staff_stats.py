@@ -1,12 +1,20 @@
 #!/usr/bin/env python3
+import sys
+import shutil
 import logging
 import argparse
+from functools import partial
 from configparser import ConfigParser
 from datetime import datetime, timedelta
 from pathlib import Path
 
 from sdo_data import SdoData
-from staff_jobs import SegmentationJob, GetStaffStatsJob
+from staff_jobs import CentersStore, SegmentationJob, GetStaffStatsJob
+from job import JobError, get_output_logger
+from manifest import Manifest, get_fingerprint
+from failures import Retrying, DeadLetterList
+from watch import DateWatcher
+from parallel import imap_unordered
 
 
 def date_range(start, end, step):
@@ -16,6 +24,106 @@ def date_range(start, end, step):
 		yield date
 		date += step
 
+
+def process_date(date, config, sdo_data, ar_segmentation, ch_segmentation, get_staff_stats, manifest = None):
+	'''Create the AR and CH segmentation maps and compute the STAFF statistics for the specified date, return False if the date was skipped
+	If a manifest is specified, the stages already completed with the same inputs are skipped, and the completed stages are recorded'''
+	
+	map_name = date.strftime('%Y%m%d_%H%M%S') + '.SegmentedMap.fits'
+	
+	# The AR and CH segmentations do not depend on each other, so they are run concurrently
+	ar_segmentation_map = Path(config.get('AR_SEGMENTATION', 'output_directory'), map_name)
+	
+	ar_aia_images = [sdo_data.get_AIA_file(date, wavelength) for wavelength in config.getintlist('AR_SEGMENTATION', 'wavelengths')]
+	if None in ar_aia_images:
+		logging.warning('AIA image missing for creating AR segmentation map %s, skipping!', ar_segmentation_map)
+		return False
+	
+	ch_segmentation_map = Path(config.get('CH_SEGMENTATION', 'output_directory'), map_name)
+	
+	ch_aia_images = [sdo_data.get_AIA_file(date, wavelength) for wavelength in config.getintlist('CH_SEGMENTATION', 'wavelengths')]
+	if None in ch_aia_images:
+		logging.warning('AIA image missing for creating CH segmentation map %s, skipping!', ch_segmentation_map)
+		return False
+	
+	segmentations = [
+		('AR_SEGMENTATION', ar_segmentation, ar_aia_images, ar_segmentation_map),
+		('CH_SEGMENTATION', ch_segmentation, ch_aia_images, ch_segmentation_map)
+	]
+	
+	running_segmentations = list()
+	
+	for stage, segmentation, aia_images, segmentation_map in segmentations:
+		fingerprint = get_stage_fingerprint(config, stage, aia_images)
+		
+		if manifest is not None and manifest.is_complete(stage, date.isoformat(), fingerprint):
+			logging.info('Segmentation map %s is up to date, skipping!', segmentation_map)
+			continue
+		
+		logging.info('Creating %s segmentation map %s', stage[:2], segmentation_map)
+		running_segmentations.append((stage, segmentation.start(aia_images, segmentation_map, date), fingerprint, segmentation_map))
+	
+	# Wait for both maps before computing the statistics, the successful segmentations are recorded even if the other failed
+	first_error = None
+	
+	for stage, running_segmentation, fingerprint, segmentation_map in running_segmentations:
+		try:
+			running_segmentation.wait()
+		except JobError as why:
+			if first_error is None:
+				first_error = why
+		else:
+			if manifest is not None:
+				manifest.record(stage, date.isoformat(), fingerprint, [segmentation_map])
+	
+	if first_error is not None:
+		raise first_error
+	
+	# Execute get_staff_stats
+	aia_images = [sdo_data.get_AIA_file(date, wavelength) for wavelength in config.getintlist('STAFF_STATS', 'wavelengths')]
+	
+	# Remove missing images
+	aia_images = [aia_image for aia_image in aia_images if aia_image is not None]
+	
+	if not aia_images:
+		logging.info('No AIA image found for computing STAFF statistics from maps %s and %s, skipping!', ar_segmentation_map, ch_segmentation_map)
+		return False
+	
+	# The statistics must be computed again if a segmentation map was created again
+	fingerprint = get_stage_fingerprint(config, 'STAFF_STATS', aia_images + [ar_segmentation_map, ch_segmentation_map])
+	
+	if manifest is not None and manifest.is_complete('STAFF_STATS', date.isoformat(), fingerprint):
+		logging.info('STAFF statistics from maps %s and %s are up to date, skipping!', ar_segmentation_map, ch_segmentation_map)
+		return False
+	
+	logging.info('Computing STAFF statistics from maps %s and %s', ar_segmentation_map, ch_segmentation_map)
+	staff_stats_files = get_staff_stats.execute(ar_segmentation_map, ch_segmentation_map, aia_images)
+	
+	if manifest is not None:
+		manifest.record('STAFF_STATS', date.isoformat(), fingerprint, staff_stats_files)
+	
+	return True
+
+def get_stage_fingerprint(config, stage, input_files):
+	'''Return the fingerprint of the input files of a stage, of its SPoCA executable and config file, and of the options of its section of the config that change its outputs'''
+	
+	parameters = {option: config.get(stage, option) for option in ['executable', 'config_file', 'wavelengths', 'output_directory']}
+	
+	# The executable can be a command name found in the PATH, if it is not found only its name is fingerprinted
+	executable = shutil.which(config.get(stage, 'executable'))
+	
+	return get_fingerprint(input_files + ([executable] if executable is not None else []) + [config.get(stage, 'config_file')], parameters)
+
+def get_centers_store(config, section):
+	'''Return the CentersStore of a segmentation section of the config, or None if it has no centers_directory'''
+	
+	centers_directory = config.get(section, 'centers_directory', fallback = None)
+	
+	if centers_directory is None:
+		return None
+	
+	return CentersStore(centers_directory, config.get(section, 'centers_file'), config.get(section, 'centers_seeding', fallback = 'nearest'))
+
 # Start point of the script
 if __name__ == '__main__':
 	
@@ -23,14 +131,29 @@ if __name__ == '__main__':
 	parser = argparse.ArgumentParser(description='Compute statistics about AR CH and QS from AIA FITS files for the STAFF viewer using the SPoCA software suite')
 	parser.add_argument('--verbose', '-v', choices = ['DEBUG', 'INFO', 'ERROR'], default = 'INFO', help='Set the logging level (default is INFO)')
 	parser.add_argument('--config-file', '-c', required = True, help = 'Path to the config file of the script')
-	parser.add_argument('--start-date', '-s', required = True, type = datetime.fromisoformat, help = 'Start date of AIA files (ISO 8601 format)')
-	parser.add_argument('--end-date', '-e', default = datetime.utcnow(), type = datetime.fromisoformat, help = 'End date of AIA files (ISO 8601 format)')
+	parser.add_argument('--start-date', '-s', type = datetime.fromisoformat, help = 'Start date of AIA files (ISO 8601 format), required unless --retry-failed or --watch is set (default in watch mode is the start of the current day)')
+	parser.add_argument('--end-date', '-e', type = datetime.fromisoformat, help = 'End date of AIA files (ISO 8601 format, default is now, or never in watch mode)')
 	parser.add_argument('--interval', '-i', default = 6, type = int, help = 'Number of hours between two results')
+	parser.add_argument('--workers', '-w', default = 1, type = int, help = 'Number of dates to process in parallel (default is 1); More than 1 requires a centers_directory and centers_seeding = reference in the AR and CH segmentation sections, so that the segmentations do not share the same class centers file and their results do not depend on the order in which the dates complete')
+	parser.add_argument('--manifest', '-m', metavar = 'MANIFEST-FILE', help = 'Path to a SQLite file to record the completed stages, so that stages already completed with the same inputs are skipped')
+	parser.add_argument('--retries', '-r', default = 0, type = int, help = 'Number of times to retry a date that failed with a transient error, e.g. of the file system (default is 0)')
+	parser.add_argument('--dead-letter', '-d', metavar = 'DEAD-LETTER-FILE', help = 'Path to a JSON file to record the dates that failed')
+	parser.add_argument('--retry-failed', action = 'store_true', help = 'Process only the dates recorded in the dead letter file, instead of the dates from start date to end date')
+	parser.add_argument('--watch', action = 'store_true', help = 'Keep running and process each date as soon as its AIA files are available')
+	parser.add_argument('--poll-interval', default = 60, type = float, help = 'Number of seconds between two searches of the AIA files in watch mode (default is 60)')
+	parser.add_argument('--grace-period', default = 3600, type = float, help = 'Number of seconds to wait for the missing AIA files of a date in watch mode, once its first file is found (default is 3600)')
 	
 	args = parser.parse_args()
 	
+	if args.retry_failed and not args.dead_letter:
+		parser.error('--retry-failed requires --dead-letter')
+	elif args.retry_failed and args.watch:
+		parser.error('--retry-failed and --watch cannot be used together')
+	elif args.start_date is None and not args.retry_failed and not args.watch:
+		parser.error('--start-date is required unless --retry-failed or --watch is set')
+	
 	# Setup the logging
-	logging.basicConfig(level = getattr(logging, args.verbose), format = '%(asctime)s %(levelname)-8s: %(message)s')
+	logging.basicConfig(level = getattr(logging, args.verbose), format = '%(asctime)s %(threadName)-12s %(levelname)-8s: %(message)s' if args.workers > 1 else '%(asctime)s %(levelname)-8s: %(message)s')
 	
 	# Parse the script config file
 	# To allow parsing list of wavelengths or quality bits
@@ -42,62 +165,107 @@ if __name__ == '__main__':
 	sdo_data = SdoData(
 		aia_file_pattern = config.get('SDO_DATA', 'aia_file_pattern'),
 		ignore_quality_bits = config.getintlist('SDO_DATA', 'ignore_quality_bits'),
-		hdu = config.getint('SDO_DATA', 'hdu')
+		hdu = config.getint('SDO_DATA', 'hdu'),
+		index_file = config.get('SDO_DATA', 'index_file', fallback = None),
+		quality_workers = config.getint('SDO_DATA', 'quality_workers', fallback = None)
 	)
 	
 	ar_segmentation = SegmentationJob(
 		config.get('AR_SEGMENTATION', 'executable'),
 		config.get('AR_SEGMENTATION', 'config_file'),
-		config.get('AR_SEGMENTATION', 'centers_file')
+		config.get('AR_SEGMENTATION', 'centers_file'),
+		timeout = config.getfloat('AR_SEGMENTATION', 'timeout', fallback = None),
+		output_logger = get_output_logger('ar_segmentation', config.get('AR_SEGMENTATION', 'output_log', fallback = None)),
+		centers_store = get_centers_store(config, 'AR_SEGMENTATION')
 	)
 	
 	ch_segmentation = SegmentationJob(
 		config.get('CH_SEGMENTATION', 'executable'),
 		config.get('CH_SEGMENTATION', 'config_file'),
-		config.get('CH_SEGMENTATION', 'centers_file')
+		config.get('CH_SEGMENTATION', 'centers_file'),
+		timeout = config.getfloat('CH_SEGMENTATION', 'timeout', fallback = None),
+		output_logger = get_output_logger('ch_segmentation', config.get('CH_SEGMENTATION', 'output_log', fallback = None)),
+		centers_store = get_centers_store(config, 'CH_SEGMENTATION')
 	)
 	
 	get_staff_stats = GetStaffStatsJob(
 		config.get('STAFF_STATS', 'executable'),
 		config.get('STAFF_STATS', 'config_file'),
-		config.get('STAFF_STATS', 'output_directory')
+		config.get('STAFF_STATS', 'output_directory'),
+		timeout = config.getfloat('STAFF_STATS', 'timeout', fallback = None),
+		output_logger = get_output_logger('staff_stats', config.get('STAFF_STATS', 'output_log', fallback = None))
 	)
 	
-	for date in date_range(args.start_date, args.end_date, timedelta(hours=args.interval)):
-		
-		map_name = date.strftime('%Y%m%d_%H%M%S') + '.SegmentedMap.fits'
-		
-		# Execute the AR segmentation
-		ar_segmentation_map = Path(config.get('AR_SEGMENTATION', 'output_directory'), map_name)
-		
-		aia_images = [sdo_data.get_AIA_file(date, wavelength) for wavelength in config.getintlist('AR_SEGMENTATION', 'wavelengths')]
-		if None in aia_images:
-			logging.warning('AIA image missing for creating AR segmentation map %s, skipping!', ar_segmentation_map)
-			continue
-		
-		logging.info('Creating AR segmentation map %s', ar_segmentation_map)
-		ar_segmentation.execute(aia_images, ar_segmentation_map)
-		
-		# Execute the CH segmentation
-		ch_segmentation_map = Path(config.get('CH_SEGMENTATION', 'output_directory'), map_name)
+	# Concurrent segmentations would read and write the same class centers file
+	# and with the nearest seeding the centers of a date would depend on which dates completed first
+	if args.workers > 1:
+		for section, segmentation in [('AR_SEGMENTATION', ar_segmentation), ('CH_SEGMENTATION', ch_segmentation)]:
+			if segmentation.centers_store is None:
+				logging.critical('Cannot process dates in parallel without a centers_directory in section %s', section)
+				sys.exit(2)
+			elif segmentation.centers_store.seeding != 'reference':
+				logging.critical('Cannot process dates in parallel without centers_seeding = reference in section %s', section)
+				sys.exit(2)
+	
+	# The records are kept per config file, so that the runs of the quicklook and science data can share the manifest
+	manifest = Manifest(args.manifest, args.config_file) if args.manifest else None
+	
+	# The jobs are mostly waiting for the SPoCA executables, so a thread pool is enough to run them in parallel
+	process = Retrying(partial(process_date, config = config, sdo_data = sdo_data, ar_segmentation = ar_segmentation, ch_segmentation = ch_segmentation, get_staff_stats = get_staff_stats, manifest = manifest), args.retries)
+	
+	dead_letter_list = DeadLetterList(args.dead_letter) if args.dead_letter else None
+	
+	wavelengths = sorted(set(config.getintlist('AR_SEGMENTATION', 'wavelengths') + config.getintlist('CH_SEGMENTATION', 'wavelengths') + config.getintlist('STAFF_STATS', 'wavelengths')))
+	
+	# The dates are processed in batches, in watch mode a batch is the dates whose AIA files became available
+	if args.retry_failed:
+		batches = [[datetime.fromisoformat(key) for key in dead_letter_list.keys]]
+	elif args.watch:
+		start_date = args.start_date or datetime.utcnow().replace(hour = 0, minute = 0, second = 0, microsecond = 0)
+		watcher = DateWatcher(sdo_data, wavelengths, start_date, timedelta(hours=args.interval), timedelta(seconds=args.grace_period), args.end_date)
+		batches = watcher.watch(args.poll_interval)
+	else:
+		batches = [list(date_range(args.start_date, args.end_date or datetime.utcnow(), timedelta(hours=args.interval)))]
+	
+	for dates in batches:
 		
-		aia_images = [sdo_data.get_AIA_file(date, wavelength) for wavelength in config.getintlist('CH_SEGMENTATION', 'wavelengths')]
-		if None in aia_images:
-			logging.warning('AIA image missing for creating CH segmentation map %s, skipping!', ch_segmentation_map)
-			continue
+		# Find all the AIA files at once, listing each directory only once
+		sdo_data.scan(dates, wavelengths)
 		
-		logging.info('Creating CH segmentation map %s', ch_segmentation_map)
-		ch_segmentation.execute(aia_images, ch_segmentation_map)
+		successes, skips, failures = 0, 0, 0
 		
-		# Execute get_staff_stats
-		aia_images = [sdo_data.get_AIA_file(date, wavelength) for wavelength in config.getintlist('STAFF_STATS', 'wavelengths')]
+		# A date with an AIA file that could not be read is failed, instead of skipped for a missing file
+		unreadable_dates = list()
+		for date in dates:
+			errors = [sdo_data.get_AIA_file_error(date, wavelength) for wavelength in wavelengths]
+			why = next((why for why in errors if why is not None), None)
+			if why is not None:
+				logging.error('Error reading AIA files for date %s: %s', date, why)
+				failures += 1
+				unreadable_dates.append(date)
+				if dead_letter_list is not None:
+					dead_letter_list.add(date.isoformat(), why)
 		
-		# Remove missing images
-		aia_images = [aia_image for aia_image in aia_images if aia_image is not None]
+		# A failed date does not stop the processing of the other dates, it is recorded in the dead letter list to be retried later
+		for date, processed, why in imap_unordered(process, [date for date in dates if date not in unreadable_dates], workers = args.workers):
+			if why is not None:
+				logging.error('Error processing date %s: %s', date, why)
+				failures += 1
+				if dead_letter_list is not None:
+					dead_letter_list.add(date.isoformat(), why)
+			else:
+				if processed:
+					successes += 1
+				else:
+					skips += 1
+				if dead_letter_list is not None:
+					dead_letter_list.remove(date.isoformat())
 		
-		if not aia_images:
-			logging.info('No AIA image found for computing STAFF statistics from maps %s and %s, skipping!', ar_segmentation_map, ch_segmentation_map)
-			continue
+		logging.info('Processed %s dates: %s succeeded, %s skipped, %s failed', successes + skips + failures, successes, skips, failures)
 		
-		logging.info('Computing STAFF statistics from maps %s and %s', ar_segmentation_map, ch_segmentation_map)
-		get_staff_stats.execute(ar_segmentation_map, ch_segmentation_map, aia_images)
+		if dead_letter_list is not None and dead_letter_list.keys:
+			logging.warning('%s dates failed, they can be processed again with --retry-failed --dead-letter %s', len(dead_letter_list.keys), args.dead_letter)
+	
+	# Report which SPoCA programs use the resources
+	for name, job in [('AR segmentation', ar_segmentation), ('CH segmentation', ch_segmentation), ('STAFF statistics', get_staff_stats)]:
+		logging.info('Resource usage of %s runs of %s: %s', job.run_count, name, job.resource_usage)
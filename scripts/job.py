@@ -1,17 +1,57 @@
 #!/usr/bin/env python3
+import os
+import time
+import signal
 import argparse
 import subprocess
+import threading
 import logging
+import logging.handlers
+from collections import namedtuple, deque
 
-__all__ = ['Job', 'JobError']
+__all__ = ['Job', 'RunningJob', 'JobResult', 'ResourceUsage', 'JobError', 'get_output_logger']
+
+class ResourceUsage(namedtuple('ResourceUsage', ['wall_time', 'user_time', 'system_time', 'max_rss'], defaults = (0.0, 0.0, 0.0, 0))):
+	'''Resource usage of a job: the wall time, user and system CPU time in seconds, and the maximum resident set size in kilobytes'''
+	
+	__slots__ = ()
+	
+	def merge(self, other):
+		'''Return the total resource usage of this and another job, the maximum resident set size is the largest of both'''
+		return ResourceUsage(self.wall_time + other.wall_time, self.user_time + other.user_time, self.system_time + other.system_time, max(self.max_rss, other.max_rss))
+	
+	def __str__(self):
+		return 'wall time {:.1f}s, user time {:.1f}s, system time {:.1f}s, max RSS {} kB'.format(*self)
 
-class Job:
-	'''Class to run an executable'''
 
-	def __init__(self, executable, positional_parameters = [], optional_parameters = {}):
+class JobResult(namedtuple('JobResult', ['exit_code', 'output', 'error'])):
+	'''Result of a job, a tuple (exit code, output, error) with the resource usage of the job as attribute'''
+	
+	def __new__(cls, exit_code, output, error, resource_usage = None):
+		self = super().__new__(cls, exit_code, output, error)
+		self.resource_usage = resource_usage
+		return self
+
+
+class Job:
+	'''Class to run an executable
+	If an output logger is given, the output and error of the executable are logged line by line while it runs, and only their last lines are kept in memory
+	The total resource usage and number of runs of the executable are kept in resource_usage and run_count'''
+	
+	# Number of lines of the output and error kept in memory when they are logged
+	OUTPUT_TAIL_SIZE = 100
+	
+	def __init__(self, executable, positional_parameters = [], optional_parameters = {}, timeout = None, output_logger = None, output_tail_size = None):
 		self.executable = executable
 		self.positional_parameters = list(positional_parameters)
 		self.optional_parameters = dict(optional_parameters)
+		# Time in seconds after which the executable is killed, None to never kill it
+		self.timeout = timeout
+		self.output_logger = output_logger
+		self.output_tail_size = self.OUTPUT_TAIL_SIZE if output_tail_size is None else output_tail_size
+		self.resource_usage = ResourceUsage()
+		self.run_count = 0
+		self._lock = threading.Lock()
 	
 	def get_command(self, positional_parameters = None, optional_parameters = None):
 		'''Return the command and the parameters'''
@@ -46,25 +86,179 @@ class Job:
 	def execute(self, input = None, positional_parameters = None, optional_parameters = None):
 		'''Run the executable with specified input and additional parameters, and return the exit code, output and error'''
 		
-		command = self.get_command(positional_parameters, optional_parameters)
+		return self.start(input, positional_parameters, optional_parameters).wait()
+	
+	def start(self, input = None, positional_parameters = None, optional_parameters = None, check = None):
+		'''Start the executable with specified input and additional parameters in the background, and return a RunningJob'''
 		
-		logging.debug('Executing job %s', ' '.join(command))
+		command = self.get_command(positional_parameters, optional_parameters)
 		
-		process = subprocess.run(command, input = input, stdout = subprocess.PIPE, stderr = subprocess.PIPE, encoding = 'utf8')
+		logging.debug('Starting job %s', ' '.join(command))
 		
-		return process.returncode, process.stdout, process.stderr
+		return RunningJob(command, input, check, self.timeout, self._add_resource_usage, self.output_logger, self.output_tail_size)
+	
+	def _add_resource_usage(self, result):
+		'''Add the resource usage of a terminated run to the total, can be called from several threads'''
+		with self._lock:
+			self.resource_usage = self.resource_usage.merge(result.resource_usage)
+			self.run_count += 1
 	
 	def __str__(self):
 		return ' '.join(self.get_command())
 
 
+class RunningJob:
+	'''Class for an executable running in the background
+	If a timeout is given, the executable and all its children are killed when it expires
+	If an on_exit function is given, it is called with the JobResult when the executable terminates
+	If an output logger is given, the lines of the output are logged with level DEBUG and those of the error with level INFO, and only the last output_tail_size lines are kept'''
+	
+	def __init__(self, command, input = None, check = None, timeout = None, on_exit = None, output_logger = None, output_tail_size = None):
+		self.command = command
+		self.check = check
+		self.timeout = timeout
+		self.timed_out = False
+		self.reaped = False
+		# Lock to never kill the process group once the process has been reaped, as its pid could have been reused
+		self._kill_lock = threading.Lock()
+		self.output_logger = output_logger
+		self.output_tail_size = output_tail_size
+		self._on_exit = on_exit
+		self._start_time = time.monotonic()
+		# The executable is started in a new session, so that it is the leader of a process group that can be killed at once
+		# Invalid characters in the output are replaced, so that reading the output never fails
+		self.process = subprocess.Popen(command, stdin = subprocess.PIPE if input is not None else None, stdout = subprocess.PIPE, stderr = subprocess.PIPE, encoding = 'utf8', errors = 'replace', start_new_session = True)
+		
+		self._timer = None
+		if timeout is not None:
+			self._timer = threading.Timer(timeout, self._kill)
+			self._timer.daemon = True
+			self._timer.start()
+		
+		# The output and error must be read while the process runs, else it could block on a full pipe
+		self._result = None
+		self._exception = None
+		self._thread = threading.Thread(target = self._communicate, args = (input,), daemon = True)
+		self._thread.start()
+	
+	def _communicate(self, input):
+		try:
+			self._result = self._run(input)
+		except Exception as why:
+			self._exception = why
+		finally:
+			if self._timer is not None:
+				self._timer.cancel()
+		
+		if self._result is not None and self._on_exit is not None:
+			self._on_exit(self._result)
+	
+	def _run(self, input):
+		'''Read the output and error until the executable closes them, reap it, and return the JobResult'''
+		
+		# The output and error are read in separate threads while the input is written, so that no pipe can block the process
+		if self.output_logger is None:
+			output, error = list(), list()
+		else:
+			output, error = deque(maxlen = self.output_tail_size), deque(maxlen = self.output_tail_size)
+		readers = [threading.Thread(target = self._read, args = (stream, chunks, level), daemon = True) for stream, chunks, level in [(self.process.stdout, output, logging.DEBUG), (self.process.stderr, error, logging.INFO)]]
+		for reader in readers:
+			reader.start()
+		
+		if input is not None:
+			try:
+				self.process.stdin.write(input)
+				self.process.stdin.close()
+			except BrokenPipeError:
+				# The executable does not read its input
+				pass
+		
+		for reader in readers:
+			reader.join()
+		
+		# Wait for the process to terminate without reaping it, so that its pid cannot be reused while the timeout can still expire
+		os.waitid(os.P_PID, self.process.pid, os.WEXITED | os.WNOWAIT)
+		
+		# The process is reaped with wait4 instead of Popen.wait, to get its resource usage
+		with self._kill_lock:
+			pid, status, rusage = os.wait4(self.process.pid, 0)
+			self.reaped = True
+		
+		self.process.returncode = os.waitstatus_to_exitcode(status)
+		resource_usage = ResourceUsage(time.monotonic() - self._start_time, rusage.ru_utime, rusage.ru_stime, rusage.ru_maxrss)
+		
+		logging.debug('Job %s terminated with exit code %s, %s', self, self.process.returncode, resource_usage)
+		
+		return JobResult(self.process.returncode, ''.join(output), ''.join(error), resource_usage)
+	
+	def _read(self, stream, chunks, level):
+		'''Read the stream until it is closed, and log its lines if there is an output logger'''
+		with stream:
+			if self.output_logger is None:
+				chunks.append(stream.read())
+			else:
+				# The lines of parallel jobs can be mixed in the same log, so they are prefixed by the pid
+				for line in stream:
+					self.output_logger.log(level, '[%s] %s', self.process.pid, line.rstrip('\n'))
+					chunks.append(line)
+	
+	def _kill(self):
+		'''Kill the process group of the executable when the timeout expired'''
+		with self._kill_lock:
+			if self.reaped:
+				# The process terminated in the meantime
+				return
+			logging.warning('Job %s did not terminate after %s seconds, killing it', self, self.timeout)
+			self.timed_out = True
+			try:
+				os.killpg(self.process.pid, signal.SIGKILL)
+			except ProcessLookupError:
+				# The process group has no more running process
+				pass
+	
+	def wait(self):
+		'''Wait for the executable to terminate, and return the JobResult (exit code, output, error)
+		If the timeout expired, a JobError is raised
+		If a check function was given, it is called with the exit code, output and error, and can raise a JobError
+		On timeout the check function is still called, so that it can clean up after the run, but its error is replaced by the timeout error'''
+		
+		self._thread.join()
+		
+		if self._exception is not None:
+			raise self._exception
+		
+		result = self._result
+		
+		if self.timed_out:
+			if self.check is not None:
+				try:
+					self.check(*result)
+				except JobError:
+					pass
+			raise JobError(self.command[0], result.exit_code, result.output, result.error, message = 'Job {executable} was killed after a timeout of {timeout} seconds', resource_usage = result.resource_usage, timeout = self.timeout)
+		
+		if self.check is not None:
+			try:
+				self.check(*result)
+			except JobError as why:
+				if why.resource_usage is None:
+					why.resource_usage = result.resource_usage
+				raise
+		
+		return result
+	
+	def __str__(self):
+		return ' '.join(self.command)
+
+
 class JobError(Exception):
-	def __init__(self, executable = None, exit_code = None, output = None, error = None, message = None, **extra):
+	def __init__(self, executable = None, exit_code = None, output = None, error = None, message = None, resource_usage = None, **extra):
 		self.executable = executable
 		self.exit_code = exit_code
 		self.output = output
 		self.error = error
 		self.message = message
+		self.resource_usage = resource_usage
 		self.extra = extra
 	
 	def __str__(self):
@@ -84,24 +278,49 @@ class JobError(Exception):
 				message += '\nOutput: {output}'.format(output = self.output)
 			if self.extra:
 				message += '\nExtra info: {extra}'.format(extra = self.extra)
+			if self.resource_usage is not None:
+				message += '\nResource usage: {resource_usage}'.format(resource_usage = self.resource_usage)
 		
 		return message
 
 
+def get_output_logger(name, output_log = None, max_bytes = 10000000, backup_count = 5):
+	'''Return a logger for the output of jobs, or None if output_log is None
+	If output_log is 'logging', the lines are passed to the log of the script, else output_log is the path of a log file, that is rotated when it reaches max_bytes'''
+	
+	if output_log is None:
+		return None
+	
+	logger = logging.getLogger('job.' + name)
+	
+	if output_log != 'logging' and not logger.handlers:
+		os.makedirs(os.path.dirname(os.path.abspath(output_log)), exist_ok = True)
+		handler = logging.handlers.RotatingFileHandler(output_log, maxBytes = max_bytes, backupCount = backup_count, encoding = 'utf8', delay = True)
+		handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)-8s: %(message)s'))
+		logger.addHandler(handler)
+		logger.setLevel(logging.DEBUG)
+		logger.propagate = False
+	
+	return logger
+
+
 # Start point of the script
 if __name__ == '__main__':
 	
 	parser = argparse.ArgumentParser(description = 'Run executable as a job', prefix_chars = '@')
 	parser.add_argument('executable', help = 'The path to the executable')
 	parser.add_argument('parameters', metavar = 'PARAM', nargs = '*', help = 'Any additional parameter')
+	parser.add_argument('@@timeout', type = float, help = 'Time in seconds after which the executable is killed')
+	parser.add_argument('@@output-log', help = 'Path to a log file where to write the output of the executable while it runs')
 	
 	args = parser.parse_args()
 	
-	job = Job(args.executable, positional_parameters = args.parameters)
+	job = Job(args.executable, positional_parameters = args.parameters, timeout = args.timeout, output_logger = get_output_logger('main', args.output_log))
 	
 	print(job)
 	
 	result = job.execute()
 	
 	print('Exit code: %s\nOutput:\n%s\nError:\n%s' % result)
+	print('Resource usage: %s' % (result.resource_usage, ))
 	
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+import os
+import json
+import hashlib
+import argparse
+import sqlite3
+import threading
+from datetime import datetime, timezone
+
+__all__ = ['Manifest', 'get_fingerprint']
+
+def get_fingerprint(input_files, parameters = None):
+	'''Return a fingerprint of the input files (path, modification time and size) and of the parameters, that changes when any of them changes'''
+	
+	digest = hashlib.sha1()
+	
+	for input_file in input_files:
+		stat = os.stat(input_file)
+		digest.update(('%s %s %s\n' % (input_file, stat.st_mtime_ns, stat.st_size)).encode('utf8'))
+	
+	digest.update(json.dumps(parameters, sort_keys = True, default = str).encode('utf8'))
+	
+	return digest.hexdigest()
+
+
+class Manifest:
+	'''Record of the completed stages of the pipeline, stored in a SQLite database
+	A stage is identified by its name, the config file of the run and a key (e.g. the date), and is complete if it was recorded with the same fingerprint of its inputs and its outputs still exist
+	So runs with different config files (e.g. quicklook and science) can share the same manifest without overwriting each other's records'''
+	
+	# Time in seconds to wait for the lock of the database held by another process
+	TIMEOUT = 60
+	
+	def __init__(self, database_file, config_file = None):
+		self.database_file = database_file
+		# The config file is identified by its absolute path
+		self.config_file = os.path.abspath(config_file) if config_file else ''
+		# The manifest can be used from several threads, so the access to the connection is serialized by a lock
+		self._lock = threading.Lock()
+		self._connection = sqlite3.connect(database_file, timeout = self.TIMEOUT, check_same_thread = False)
+		with self._lock, self._connection:
+			self._connection.execute('CREATE TABLE IF NOT EXISTS stages (stage TEXT NOT NULL, config TEXT NOT NULL, key TEXT NOT NULL, fingerprint TEXT NOT NULL, outputs TEXT NOT NULL, completed TEXT NOT NULL, PRIMARY KEY (stage, config, key))')
+	
+	def is_complete(self, stage, key, fingerprint):
+		'''Return True if the stage was completed for the key with the same fingerprint, and its outputs still exist'''
+		
+		with self._lock:
+			row = self._connection.execute('SELECT fingerprint, outputs FROM stages WHERE stage = ? AND config = ? AND key = ?', (stage, self.config_file, str(key))).fetchone()
+		
+		if row is None or row[0] != fingerprint:
+			return False
+		
+		return all(os.path.exists(output) for output in json.loads(row[1]))
+	
+	def record(self, stage, key, fingerprint, outputs = []):
+		'''Record that the stage was completed for the key, with the fingerprint of its inputs and the paths of its outputs'''
+		
+		with self._lock, self._connection:
+			self._connection.execute('INSERT OR REPLACE INTO stages (stage, config, key, fingerprint, outputs, completed) VALUES (?, ?, ?, ?, ?, ?)', (stage, self.config_file, str(key), fingerprint, json.dumps([str(output) for output in outputs]), datetime.now(timezone.utc).isoformat()))
+	
+	def forget(self, stage = None, key = None):
+		'''Remove the records of the config file of the stage (all stages if None) for the key (all keys if None), so that they are processed again'''
+		
+		with self._lock, self._connection:
+			self._connection.execute('DELETE FROM stages WHERE (? IS NULL OR stage = ?) AND config = ? AND (? IS NULL OR key = ?)', (stage, stage, self.config_file, key, key))
+	
+	def get_records(self, stage = None):
+		'''Return the list of records (stage, key, fingerprint, outputs, completed) of the config file of the stage (all stages if None)'''
+		
+		with self._lock:
+			rows = self._connection.execute('SELECT stage, key, fingerprint, outputs, completed FROM stages WHERE (? IS NULL OR stage = ?) AND config = ? ORDER BY stage, key', (stage, stage, self.config_file)).fetchall()
+		
+		return [(stage, key, fingerprint, json.loads(outputs), completed) for stage, key, fingerprint, outputs, completed in rows]
+	
+	def close(self):
+		with self._lock:
+			self._connection.close()
+
+
+# Start point of the script
+if __name__ == '__main__':
+	
+	parser = argparse.ArgumentParser(description='Print or forget the completed stages recorded in a manifest')
+	parser.add_argument('database_file', metavar = 'MANIFEST-FILE', help = 'The path to the SQLite manifest file')
+	parser.add_argument('--config-file', '-c', help = 'The path to the config file of the script that recorded the stages')
+	parser.add_argument('--stage', help = 'The name of the stage (default is all stages)')
+	parser.add_argument('--key', help = 'The key of the stage, e.g. the date (default is all keys)')
+	parser.add_argument('--forget', action = 'store_true', help = 'Remove the records, so that the stages are processed again on the next run')
+	
+	args = parser.parse_args()
+	
+	manifest = Manifest(args.database_file, args.config_file)
+	
+	if args.forget:
+		manifest.forget(args.stage, args.key)
+	else:
+		for stage, key, fingerprint, outputs, completed in manifest.get_records(args.stage):
+			if args.key is None or key == args.key:
+				print(stage, key, completed, ' '.join(outputs))
+	
+	manifest.close()
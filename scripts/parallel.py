@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+__all__ = ['imap_unordered']
+
+def imap_unordered(function, items, workers = 1, executor_class = ThreadPoolExecutor, max_pending = None, **executor_options):
+	'''Apply the function to each item using a pool of workers, and yield (item, result, exception) in order of completion
+	At most max_pending items (by default the number of workers) are submitted to the pool at any time
+	The executor_options (e.g. initializer) are passed to the executor_class
+	With a single worker, the items are processed one by one in the current process'''
+	
+	if workers <= 1:
+		for item in items:
+			try:
+				result = function(item)
+			except Exception as why:
+				yield item, None, why
+			else:
+				yield item, result, None
+		return
+	
+	if max_pending is None:
+		max_pending = workers
+	
+	items = iter(items)
+	pending = dict()
+	
+	with executor_class(workers, **executor_options) as executor:
+		while True:
+			# Keep the pool fed, but never submit more than max_pending items
+			for item in items:
+				pending[executor.submit(function, item)] = item
+				if len(pending) >= max_pending:
+					break
+			
+			if not pending:
+				break
+			
+			done, not_done = wait(pending, return_when = FIRST_COMPLETED)
+			for future in done:
+				item = pending.pop(future)
+				exception = future.exception()
+				if exception is None:
+					yield item, future.result(), None
+				else:
+					yield item, None, exception
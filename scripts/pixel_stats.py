@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+import numpy
+
+__all__ = ['PixelStats', 'QuantileSketch', 'SplitStats']
+
+class PixelStats:
+	'''Accumulator for the count, minimum, maximum, mean and standard deviation of pixel values, and optionally the skewness and kurtosis
+	Pixels can be added in several parts, and accumulators can be merged, the result is the same as for all the pixels at once'''
+	
+	# Number of pixels processed at once, so that the temporary arrays stay small and in the CPU cache
+	CHUNK_SIZE = 65536
+	
+	def __init__(self, higher_moments = False):
+		# The third and fourth moments are only computed if needed, because they double the cost of an update
+		self.higher_moments = higher_moments
+		self.count = 0
+		self.min = numpy.inf
+		self.max = -numpy.inf
+		self.mean = 0.0
+		# Sum of the squared, cubed and fourth power deviations from the mean
+		self.m2 = 0.0
+		self.m3 = 0.0
+		self.m4 = 0.0
+	
+	@property
+	def sum(self):
+		return self.mean * self.count
+	
+	@property
+	def variance(self):
+		return self.m2 / self.count if self.count else numpy.nan
+	
+	@property
+	def std(self):
+		return numpy.sqrt(self.variance)
+	
+	@property
+	def skewness(self):
+		'''The biased sample skewness, like scipy.stats.skew with bias = True'''
+		return numpy.sqrt(self.count) * self.m3 / self.m2**1.5 if self.m2 else numpy.nan
+	
+	@property
+	def kurtosis(self):
+		'''The biased sample excess kurtosis, like scipy.stats.kurtosis with fisher = True and bias = True'''
+		return self.count * self.m4 / (self.m2 * self.m2) - 3 if self.m2 else numpy.nan
+	
+	def update(self, pixels):
+		'''Add the pixels to the statistics, the pixels must all be finite'''
+		
+		pixels = numpy.ravel(pixels)
+		
+		for start in range(0, pixels.size, self.CHUNK_SIZE):
+			chunk = pixels[start:start + self.CHUNK_SIZE]
+			count = chunk.size
+			mean = chunk.sum(dtype = numpy.float64) / count
+			deviations = numpy.subtract(chunk, mean, dtype = numpy.float64)
+			if self.higher_moments:
+				squared_deviations = deviations * deviations
+				self._merge(count, chunk.min(), chunk.max(), mean, squared_deviations.sum(), numpy.dot(squared_deviations, deviations), numpy.dot(squared_deviations, squared_deviations))
+			else:
+				self._merge(count, chunk.min(), chunk.max(), mean, numpy.dot(deviations, deviations))
+		
+		return self
+	
+	def merge(self, other):
+		'''Add the statistics of another accumulator to this one'''
+		
+		if self.higher_moments and not other.higher_moments:
+			raise ValueError('Cannot merge an accumulator without higher moments')
+		
+		if other.count:
+			self._merge(other.count, other.min, other.max, other.mean, other.m2, other.m3, other.m4)
+		
+		return self
+	
+	def _merge(self, count, minimum, maximum, mean, m2, m3 = 0.0, m4 = 0.0):
+		# Combine the moments using the parallel algorithm of Chan et al., extended to the higher moments by Pébay
+		total_count = self.count + count
+		delta = mean - self.mean
+		if self.higher_moments:
+			# The higher moments depend on the lower moments before the merge
+			self.m4 += m4 + delta**4 * self.count * count * (self.count * self.count - self.count * count + count * count) / total_count**3 + 6 * delta * delta * (self.count * self.count * m2 + count * count * self.m2) / total_count**2 + 4 * delta * (self.count * m3 - count * self.m3) / total_count
+			self.m3 += m3 + delta**3 * self.count * count * (self.count - count) / total_count**2 + 3 * delta * (self.count * m2 - count * self.m2) / total_count
+		self.m2 += m2 + delta * delta * self.count * count / total_count
+		self.mean += delta * count / total_count
+		self.count = total_count
+		self.min = min(self.min, minimum)
+		self.max = max(self.max, maximum)
+
+
+class QuantileSketch:
+	'''Mergeable sketch of the distribution of pixel values, to estimate percentiles with a bounded error in fixed memory
+	The absolute values are counted in logarithmic bins ]gamma**(k-1), gamma**k] with gamma = (1 + accuracy) / (1 - accuracy), and each bin
+	is represented by the value 2 * gamma**k / (gamma + 1), that is within a relative error of accuracy of any value of the bin
+	Values with an absolute value below min_value are counted as 0
+	So the estimated percentile is within a relative error of accuracy (or an absolute error of min_value) of the exact percentile
+	computed with the linear interpolation of numpy.percentile'''
+	
+	# Default relative accuracy of the percentiles
+	ACCURACY = 0.001
+	
+	# Default smallest absolute value that is not counted as 0
+	MIN_VALUE = 1e-3
+	
+	def __init__(self, accuracy = None, min_value = None):
+		self.accuracy = self.ACCURACY if accuracy is None else accuracy
+		self.min_value = self.MIN_VALUE if min_value is None else min_value
+		self.gamma = (1 + self.accuracy) / (1 - self.accuracy)
+		self.log_gamma = numpy.log(self.gamma)
+		self.count = 0
+		self.zero_count = 0
+		# Counts of the bins of the positive and negative values, as an array of counts and the key of the first bin
+		self.positive_bins = (numpy.zeros(0, dtype = numpy.int64), 0)
+		self.negative_bins = (numpy.zeros(0, dtype = numpy.int64), 0)
+	
+	def update(self, pixels):
+		'''Add the pixels to the sketch, the pixels must all be finite'''
+		
+		pixels = numpy.ravel(pixels)
+		
+		positive = pixels[pixels >= self.min_value]
+		negative = pixels[pixels <= -self.min_value]
+		
+		self.positive_bins = self._add_bins(self.positive_bins, self._get_keys(positive))
+		self.negative_bins = self._add_bins(self.negative_bins, self._get_keys(-negative))
+		self.zero_count += pixels.size - positive.size - negative.size
+		self.count += pixels.size
+		
+		return self
+	
+	def merge(self, other):
+		'''Add the counts of another sketch with the same accuracy and min_value to this one'''
+		
+		if (other.accuracy, other.min_value) != (self.accuracy, self.min_value):
+			raise ValueError('Cannot merge sketches with different accuracy or min_value')
+		
+		self.positive_bins = self._merge_bins(self.positive_bins, other.positive_bins)
+		self.negative_bins = self._merge_bins(self.negative_bins, other.negative_bins)
+		self.zero_count += other.zero_count
+		self.count += other.count
+		
+		return self
+	
+	def percentile(self, percentiles):
+		'''Return the estimated values of the percentiles (between 0 and 100), using the same interpolation between ranks as numpy.percentile'''
+		
+		if self.count == 0:
+			raise ValueError('Cannot compute percentiles of an empty sketch')
+		
+		# The bins sorted by increasing value, with their representative value and the cumulated counts
+		negative_counts, negative_offset = self.negative_bins
+		positive_counts, positive_offset = self.positive_bins
+		values = numpy.concatenate([
+			- self._get_values(numpy.arange(negative_offset, negative_offset + negative_counts.size))[::-1],
+			[0.],
+			self._get_values(numpy.arange(positive_offset, positive_offset + positive_counts.size))
+		])
+		cumulated_counts = numpy.cumsum(numpy.concatenate([negative_counts[::-1], [self.zero_count], positive_counts]))
+		
+		ranks = numpy.asarray(percentiles, dtype = numpy.float64) / 100 * (self.count - 1)
+		lower_ranks = numpy.floor(ranks)
+		upper_ranks = numpy.ceil(ranks)
+		
+		# The value of rank r is the value of the first bin whose cumulated count is greater than r
+		lower_values = values[numpy.searchsorted(cumulated_counts, lower_ranks, side = 'right')]
+		upper_values = values[numpy.searchsorted(cumulated_counts, upper_ranks, side = 'right')]
+		
+		return lower_values + (upper_values - lower_values) * (ranks - lower_ranks)
+	
+	def _get_keys(self, values):
+		'''Return the keys of the bins of the positive values'''
+		return numpy.ceil(numpy.log(values, dtype = numpy.float64) / self.log_gamma).astype(numpy.int64)
+	
+	def _get_values(self, keys):
+		'''Return the representative values of the bins'''
+		return 2 * numpy.power(self.gamma, keys) / (self.gamma + 1)
+	
+	@staticmethod
+	def _add_bins(bins, keys):
+		'''Return the bins with the keys counted'''
+		if keys.size == 0:
+			return bins
+		offset = keys.min()
+		return QuantileSketch._merge_bins(bins, (numpy.bincount(keys - offset), offset))
+	
+	@staticmethod
+	def _merge_bins(bins, other_bins):
+		'''Return the sum of the counts of 2 bins'''
+		(counts, offset), (other_counts, other_offset) = bins, other_bins
+		if other_counts.size == 0:
+			return bins
+		if counts.size == 0:
+			return other_counts.copy(), other_offset
+		new_offset = min(offset, other_offset)
+		new_counts = numpy.zeros(max(offset + counts.size, other_offset + other_counts.size) - new_offset, dtype = numpy.int64)
+		new_counts[offset - new_offset:offset - new_offset + counts.size] += counts
+		new_counts[other_offset - new_offset:other_offset - new_offset + other_counts.size] += other_counts
+		return new_counts, new_offset
+
+
+class SplitStats:
+	'''Accumulator for the PixelStats and percentiles of the finite pixels of an image, and of those selected by a subset mask
+	The image can be added in several parts (e.g. bands of rows), and each pixel is read once for the moments
+	With the exact percentile engine, the finite pixels are gathered in a single buffer, with the subset at the front and the others at the back,
+	that is partitioned in place for the percentiles; With the sketch engine, the percentiles are estimated from a QuantileSketch in fixed memory'''
+	
+	# The percentile engines
+	PERCENTILE_ENGINES = ['exact', 'sketch']
+	
+	def __init__(self, size, percentile_engine = 'exact', percentile_accuracy = None):
+		if percentile_engine not in self.PERCENTILE_ENGINES:
+			raise ValueError('Unknown percentile engine %s' % percentile_engine)
+		# Number of pixels of the image
+		self.size = size
+		self.percentile_engine = percentile_engine
+		self.subset_stats = PixelStats()
+		self.other_stats = PixelStats()
+		if percentile_engine == 'sketch':
+			self.subset_sketch = QuantileSketch(percentile_accuracy)
+			self.other_sketch = QuantileSketch(percentile_accuracy)
+		self._buffer = None
+		self._front = 0
+		self._back = size
+	
+	def update(self, pixels, subset_mask):
+		'''Add a part of the image and the corresponding part of the subset mask'''
+		
+		pixels = numpy.ravel(pixels)
+		subset_mask = numpy.ravel(subset_mask)
+		
+		finite = numpy.isfinite(pixels)
+		in_subset = finite & subset_mask
+		out_subset = finite & ~subset_mask
+		
+		if self.percentile_engine == 'sketch':
+			subset_pixels = pixels[in_subset]
+			other_pixels = pixels[out_subset]
+			self.subset_sketch.update(subset_pixels)
+			self.other_sketch.update(other_pixels)
+		else:
+			if self._buffer is None:
+				self._buffer = numpy.empty(self.size, dtype = pixels.dtype)
+			
+			subset_pixels = self._buffer[self._front:self._front + numpy.count_nonzero(in_subset)]
+			numpy.compress(in_subset, pixels, out = subset_pixels)
+			self._front += subset_pixels.size
+			
+			other_pixels = self._buffer[self._back - numpy.count_nonzero(out_subset):self._back]
+			numpy.compress(out_subset, pixels, out = other_pixels)
+			self._back -= other_pixels.size
+		
+		self.subset_stats.update(subset_pixels)
+		self.other_stats.update(other_pixels)
+		
+		return self
+	
+	def get_results(self, percentiles):
+		'''Return the PixelStats and percentiles of all the pixels, and of the subset'''
+		
+		image_stats = PixelStats().merge(self.subset_stats).merge(self.other_stats)
+		
+		if self.percentile_engine == 'sketch':
+			subset_percentiles = self.subset_sketch.percentile(percentiles)
+			image_percentiles = QuantileSketch(self.subset_sketch.accuracy).merge(self.subset_sketch).merge(self.other_sketch).percentile(percentiles)
+			return (image_stats, image_percentiles), (self.subset_stats, subset_percentiles)
+		
+		# Move the other pixels right after the subset, so that the buffer holds all the finite pixels contiguously
+		count = self.size - self._back
+		self._buffer[self._front:self._front + count] = self._buffer[self._back:]
+		self._back = self._front + count
+		
+		# Partitioning the subset only reorders the front of the buffer, so the buffer still holds all the pixels
+		subset_percentiles = numpy.percentile(self._buffer[:self._front], percentiles, overwrite_input = True)
+		image_percentiles = numpy.percentile(self._buffer[:self._back], percentiles, overwrite_input = True)
+		
+		return (image_stats, image_percentiles), (self.subset_stats, subset_percentiles)
@@ -1,4 +1,5 @@
 #!/usr/bin/env python3
+import os
 import logging
 import argparse
 import string
@@ -6,8 +7,13 @@ import json
 import glob
 import copy
 import collections
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+import numpy
 import pandas
 
+from parallel import imap_unordered
+
 HTML_TEMPLATE = string.Template('''
 <!DOCTYPE html>
 <html lang="en">
@@ -29,6 +35,63 @@ HTML_TEMPLATE = string.Template('''
 </html>
 ''')
 
+# Template of the HTML document with the charts of all columns, the chart configs are built in the browser from the series arrays
+SINGLE_DOCUMENT_TEMPLATE = string.Template('''
+<!DOCTYPE html>
+<html lang="en">
+<head>
+	<meta charset="utf-8">
+	<meta name="viewport" content="width=device-width, initial-scale=1, shrink-to-fit=no">
+		<!-- Amcharts 4 library -->
+		<script src="https://cdn.amcharts.com/lib/4/core.js"></script>
+		<script src="https://cdn.amcharts.com/lib/4/charts.js"></script>
+		<title>${title}</title>
+</head>
+
+<body>
+	<script type="text/javascript">
+		var columns = ${columns};
+		var stats_type = ${stats_type};
+		var chart_config_template = ${chart_config};
+		var series_config_template = ${series_config};
+		var series = ${series};
+		
+		columns.forEach(function(column, index) {
+			var chart_config = JSON.parse(JSON.stringify(chart_config_template));
+			chart_config.titles[0].text = column + ' ' + stats_type;
+			
+			series.forEach(function(serie) {
+				if (!(column in serie.columns)) {
+					return;
+				}
+				var series_config = JSON.parse(JSON.stringify(series_config_template));
+				series_config.name = serie.name;
+				series_config.stroke = serie.color;
+				series_config.dataFields.valueY = column;
+				series_config.data = [];
+				var values = serie.columns[column];
+				for (var i = 0; i < values.length; i++) {
+					if (values[i] !== null) {
+						var point = {timestamp: serie.timestamp[i]};
+						point[column] = values[i];
+						series_config.data.push(point);
+					}
+				}
+				chart_config.series.push(series_config);
+			});
+			
+			var chart = document.createElement('div');
+			chart.id = 'chart' + index;
+			chart.style.width = '100%';
+			chart.style.height = '500px';
+			document.body.appendChild(chart);
+			am4core.createFromConfig(chart_config, chart.id);
+		});
+	</script>
+</body>
+</html>
+''')
+
 COLORS = ['black', 'red', 'green', 'blue']
 
 CHART_CONFIG = {
@@ -116,6 +179,9 @@ CHART_CONFIG = {
 	'data': []
 }
 
+# Name of the column with the csv file name of each row
+SOURCE_COLUMN = '_source'
+
 SERIES_CONFIG = {
 	'type': 'LineSeries',
 	'name': '',
@@ -133,10 +199,74 @@ def get_series_filenames(series_list):
 		series_filenames[series_name].extend(glob.iglob(glob_pattern, recursive=True))
 	return series_filenames
 
-def get_series_dataframes(series_filenames, time_column, stats_type = None):
+def read_csv_file(filename, time_column):
+	'''Return a DataFrame with the rows of a csv file, indexed by the time column, and with the name of the file in the SOURCE_COLUMN'''
+	dataframe = pandas.read_csv(filename, index_col = time_column, parse_dates = True)
+	dataframe[SOURCE_COLUMN] = filename
+	return dataframe
+
+def get_file_signature(filename):
+	'''Return a signature of the file that changes when the file is modified'''
+	stat = os.stat(filename)
+	return stat.st_mtime_ns, stat.st_size
+
+def read_csv_files(filenames, time_column, workers = 1, cache_file = None):
+	'''Return a dict of filename to a DataFrame with the rows of the csv file
+	The files are parsed in parallel by several worker processes
+	If a cache file is specified, only the files that are not in the cache, or that were modified since, are parsed'''
+	
+	signatures = {filename: get_file_signature(filename) for filename in filenames}
+	
+	# The cache is a pickle of the signatures of the files and a single DataFrame with the rows of all the files, that is faster to load than many small ones
+	# As the single DataFrame has the columns of all the files, the columns and their types are kept for each file
+	cache = {'time_column': time_column, 'signatures': dict(), 'dtypes': dict(), 'dataframe': None}
+	if cache_file and os.path.exists(cache_file):
+		try:
+			cache = pandas.read_pickle(cache_file)
+		except Exception as why:
+			logging.warning('Could not read cache file %s, ignoring it: %s', cache_file, why)
+		else:
+			if cache['time_column'] != time_column or 'dtypes' not in cache:
+				logging.info('Cache file %s was made for another time column or version, ignoring it', cache_file)
+				cache = {'time_column': time_column, 'signatures': dict(), 'dtypes': dict(), 'dataframe': None}
+	
+	cached_filenames = set(filename for filename, signature in signatures.items() if cache['signatures'].get(filename) == signature)
+	new_filenames = [filename for filename in filenames if filename not in cached_filenames]
+	
+	file_dataframes = dict()
+	if cached_filenames:
+		for filename, dataframe in cache['dataframe'].groupby(SOURCE_COLUMN, sort = False):
+			if filename in cached_filenames:
+				dtypes = cache['dtypes'][filename]
+				file_dataframes[filename] = dataframe[dtypes.index].astype(dtypes)
+	
+	logging.info('Parsing %s csv files, %s files found in cache', len(new_filenames), len(cached_filenames))
+	
+	for filename, dataframe, why in imap_unordered(partial(read_csv_file, time_column = time_column), new_filenames, workers = workers, executor_class = ProcessPoolExecutor, max_pending = 4 * workers):
+		if why is not None:
+			logging.error('Could not read csv file %s: %s', filename, why)
+			del signatures[filename]
+		else:
+			file_dataframes[filename] = dataframe
+	
+	if cache_file and new_filenames:
+		logging.info('Writing cache file %s', cache_file)
+		temporary_file = '%s.%s.tmp' % (cache_file, os.getpid())
+		dataframe = pandas.concat(file_dataframes.values()) if file_dataframes else None
+		dtypes = {filename: dataframe.dtypes for filename, dataframe in file_dataframes.items()}
+		pandas.to_pickle({'time_column': time_column, 'signatures': signatures, 'dtypes': dtypes, 'dataframe': dataframe}, temporary_file)
+		os.replace(temporary_file, cache_file)
+	
+	return {filename: dataframe.drop(columns = SOURCE_COLUMN) for filename, dataframe in file_dataframes.items()}
+
+def get_series_dataframes(series_filenames, time_column, stats_type = None, workers = 1, cache_file = None):
+	# The files of all the series are read at once, so that the cache holds all of them
+	all_filenames = list(dict.fromkeys(filename for filenames in series_filenames.values() for filename in filenames))
+	file_dataframes = read_csv_files(all_filenames, time_column, workers, cache_file)
+	
 	series_dataframes = dict()
 	for series_name, filenames in series_filenames.items():
-		dataframe = pandas.concat(pandas.read_csv(filename, index_col = time_column, parse_dates = True) for filename in filenames)
+		dataframe = pandas.concat(file_dataframes[filename] for filename in filenames if filename in file_dataframes)
 		if stats_type:
 			dataframe = dataframe.loc[dataframe['Type'] == stats_type]
 		dataframe['timestamp'] = pandas.to_numeric(dataframe.index)/1000000
@@ -155,12 +285,38 @@ def get_columns(series_dataframes, columns = None):
 	
 	return dataframes_columns
 
-def get_data(dataframe, column):
+def get_downsample_positions(dataframe, column, max_points):
+	'''Return the sorted positions of at most max_points rows of the dataframe with a value in the column (at least 2 for a numeric column)
+	The rows are split in buckets of consecutive rows, and for each bucket the rows with the minimum and maximum value of the column are kept, so that the peaks are still visible'''
+	
+	# Like in get_data, the rows without a value are dropped, so that no bucket is empty
+	valid_positions = numpy.flatnonzero(dataframe[column].notna().to_numpy())
+	
+	if len(valid_positions) <= max_points:
+		return valid_positions
+	
+	bucket_count = max(max_points // 2, 1)
+	buckets = numpy.arange(len(valid_positions)) * bucket_count // len(valid_positions)
+	
+	if pandas.api.types.is_numeric_dtype(dataframe[column]):
+		# The values are indexed by their position among the valid rows, so that idxmin and idxmax return positions
+		grouped_values = pandas.Series(dataframe[column].to_numpy()[valid_positions]).groupby(buckets)
+		return valid_positions[numpy.union1d(grouped_values.idxmin().to_numpy(), grouped_values.idxmax().to_numpy())]
+	else:
+		return valid_positions[numpy.flatnonzero(numpy.diff(buckets, prepend = -1))]
+
+def downsample(dataframe, column, max_points):
+	'''Return at most max_points rows of the dataframe, see get_downsample_positions'''
+	return dataframe.iloc[get_downsample_positions(dataframe, column, max_points)]
+
+def get_data(dataframe, column, max_points = None):
 	dataframe = dataframe.get(['timestamp', column])
 	dataframe = dataframe.dropna()
+	if max_points:
+		dataframe = downsample(dataframe, column, max_points)
 	return dataframe.to_dict('records')
 
-def get_chart_config(series_dataframes, column, stats_type):
+def get_chart_config(series_dataframes, column, stats_type, max_points = None):
 	
 	chart_config = copy.deepcopy(CHART_CONFIG)
 	chart_config['titles'][0]['text'] = '%s %s' % (column, stats_type or '')
@@ -169,12 +325,41 @@ def get_chart_config(series_dataframes, column, stats_type):
 		series_config = copy.deepcopy(SERIES_CONFIG)
 		series_config['name'] = series_name
 		series_config['stroke'] = color
-		series_config['data'] = get_data(dataframe, column)
+		series_config['data'] = get_data(dataframe, column, max_points)
 		series_config['dataFields']['valueY'] = column
 		chart_config['series'].append(series_config)
 	
 	return chart_config
 
+def get_series_bundle(series_name, dataframe, columns, color, max_points = None):
+	'''Return the JSON of a series, with the timestamps and the values of each column as arrays
+	If max_points is specified, the rows kept are those selected by the downsampling of any of the columns'''
+	
+	columns = [column for column in columns if column in dataframe.columns]
+	
+	if max_points:
+		positions = numpy.unique(numpy.concatenate([get_downsample_positions(dataframe, column, max_points) for column in columns] or [numpy.arange(0)]))
+		dataframe = dataframe.iloc[positions]
+	
+	# The arrays are serialized by pandas, missing values become null
+	columns_json = ', '.join('%s: %s' % (json.dumps(column), dataframe[column].to_json(orient = 'values')) for column in columns)
+	return '{"name": %s, "color": %s, "timestamp": %s, "columns": {%s}}' % (json.dumps(series_name), json.dumps(color), dataframe['timestamp'].to_json(orient = 'values'), columns_json)
+
+def get_single_document(series_dataframes, columns, stats_type, max_points = None):
+	'''Return a HTML document with the charts of all the columns, where the data of each series is written once and shared by all the charts'''
+	
+	columns = sorted(columns)
+	series_bundles = [get_series_bundle(series_name, dataframe, columns, color, max_points) for (series_name, dataframe), color in zip(series_dataframes.items(), COLORS)]
+	
+	return SINGLE_DOCUMENT_TEMPLATE.substitute(
+		title = stats_type or 'Statistics',
+		columns = json.dumps(columns),
+		stats_type = json.dumps(stats_type or ''),
+		chart_config = json.dumps(CHART_CONFIG),
+		series_config = json.dumps(SERIES_CONFIG),
+		series = '[%s]' % ',\n'.join(series_bundles)
+	)
+
 # Start point of the script
 if __name__ == '__main__':
 	
@@ -185,15 +370,26 @@ if __name__ == '__main__':
 	parser.add_argument('--column', '-c', action = 'append', help = 'The columns to plot; Can be specified multiple times for more than 1 column; If not specified, all columns will be plotted')
 	parser.add_argument('--time-column', '-t', required = True, help = 'The name of the column containing the time index')
 	parser.add_argument('--stats-type', help = 'For staff stats, filter by type')
+	parser.add_argument('--workers', '-w', default = 1, type = int, help = 'Number of processes to parse the csv files (default is 1)')
+	parser.add_argument('--max-points', type = int, help = 'Maximal number of points to plot for each series, the series with more points are downsampled keeping the minimum and maximum values (default is to plot all points)')
+	parser.add_argument('--single-file', metavar = 'HTML-FILE', help = 'Write the charts of all the columns in a single HTML file, where the data of each series is written only once')
+	parser.add_argument('--cache-file', help = 'Path to a file to cache the parsed csv files, so that only new or modified files are parsed')
 	args = parser.parse_args()
 	
 	# Setup the logging
 	logging.basicConfig(level = getattr(logging, args.verbose), format = '%(asctime)s %(levelname)-8s: %(message)s')
 	
 	series_filenames = get_series_filenames(args.series)
-	series_dataframes = get_series_dataframes(series_filenames, args.time_column, args.stats_type)
+	series_dataframes = get_series_dataframes(series_filenames, args.time_column, args.stats_type, args.workers, args.cache_file)
 	columns = get_columns(series_dataframes, args.column)
-	for column in columns:
-		chart_config = get_chart_config(series_dataframes, column, args.stats_type)
-		with open('%s.html' % column, 'wt') as file:
-			file.write(HTML_TEMPLATE.substitute(chart_config = json.dumps(chart_config, indent = 2), column = column))
+	
+	if args.single_file:
+		# The timestamp is the x axis of every chart, not a column to plot
+		columns.discard('timestamp')
+		with open(args.single_file, 'wt') as file:
+			file.write(get_single_document(series_dataframes, columns, args.stats_type, args.max_points))
+	else:
+		for column in columns:
+			chart_config = get_chart_config(series_dataframes, column, args.stats_type, args.max_points)
+			with open('%s.html' % column, 'wt') as file:
+				file.write(HTML_TEMPLATE.substitute(chart_config = json.dumps(chart_config, indent = 2), column = column))
@@ -1,9 +1,14 @@
 #!/usr/bin/env python3
+import os
 import logging
 import argparse
 from datetime import datetime
-from glob import glob
-from astropy.io import fits
+from glob import glob, has_magic
+from fnmatch import fnmatchcase
+from concurrent.futures import ThreadPoolExecutor
+
+from sdo_index import SdoIndex
+from fits_header import read_header_keywords
 
 
 __all__ = ['SdoData']
@@ -59,7 +64,9 @@ class SdoData:
 	
 	# File pattern for AIA FITS files that can be formated with a date and a wavelength
 	# File pattern for HMI FITS files that can be formated with a date
-	def __init__(self, aia_file_pattern = None, hmi_file_pattern = None, ignore_quality_bits = None, hdu = None, quality_keyword = None):
+	# Path to a SQLite file to keep a persistent index of the files and their quality between runs
+	# Number of threads to check the quality of the files concurrently
+	def __init__(self, aia_file_pattern = None, hmi_file_pattern = None, ignore_quality_bits = None, hdu = None, quality_keyword = None, index_file = None, quality_workers = None):
 		self.aia_file_pattern = aia_file_pattern
 		self.hmi_file_pattern = hmi_file_pattern
 		self.ignore_quality_bits = self.IGNORE_QUALITY_BITS if ignore_quality_bits is None else ignore_quality_bits
@@ -67,42 +74,198 @@ class SdoData:
 		self.quality_keyword = self.QUALITY_KEYWORD if quality_keyword is None else quality_keyword
 		self._aia_file_cache = dict()
 		self._hmi_file_cache = dict()
+		# The errors of the files whose quality could not be read, and of the AIA files that could not be found because of them
+		self._quality_errors = dict()
+		self._aia_file_errors = dict()
+		self.index = SdoIndex(index_file) if index_file else None
+		self._quality_executor = ThreadPoolExecutor(quality_workers) if quality_workers and quality_workers > 1 else None
 	
 	def get_AIA_file(self, date, wavelength):
 		'''Return the path to a AIA FITS file for the specified date and wavelength'''
 		if (date, wavelength) not in self._aia_file_cache:
-			self._aia_file_cache[(date, wavelength)] = self.get_good_quality_file(self.aia_file_pattern.format(date=date, wavelength=wavelength))
+			file_paths = self.get_candidate_files(self.aia_file_pattern.format(date=date, wavelength=wavelength))
+			self._set_AIA_file((date, wavelength), file_paths, self.select_good_quality_file(file_paths))
 		return self._aia_file_cache[(date, wavelength)]
 	
+	def get_AIA_file_error(self, date, wavelength):
+		'''Return the error of a file whose quality could not be read if no AIA FITS file was found for the specified date and wavelength, else None'''
+		return self._aia_file_errors.get((date, wavelength))
+	
+	def _set_AIA_file(self, slot, file_paths, file_path):
+		'''Cache the AIA FITS file selected among the candidate files of the slot (date, wavelength), and if there is none, the error of the first candidate that could not be read'''
+		
+		self._aia_file_cache[slot] = file_path
+		self._aia_file_errors.pop(slot, None)
+		
+		errors = [self._quality_errors.pop(candidate) for candidate in file_paths if candidate in self._quality_errors]
+		if file_path is None and errors:
+			self._aia_file_errors[slot] = errors[0]
+	
 	def get_HMI_file(self, date):
 		'''Return the path to a HMI FITS file for the specified date'''
 		if date not in self._hmi_file_cache:
 			self._hmi_file_cache[date] = self.get_good_quality_file(self.hmi_file_pattern.format(date=date))
 		return self._hmi_file_cache[date]
 	
-	def get_good_quality_file(self, file_pattern):
+	def clear_cache(self, dates = None, missing_only = False):
+		'''Forget the files found for the dates (all the dates if None), or only the missing ones, so that they are searched again'''
+		
+		for cache in (self._aia_file_cache, self._hmi_file_cache):
+			# The keys of the AIA cache are (date, wavelength), and of the HMI cache the date
+			for key in [key for key, file_path in cache.items() if not missing_only or file_path is None]:
+				if dates is None or (key[0] if isinstance(key, tuple) else key) in dates:
+					del cache[key]
+					self._aia_file_errors.pop(key, None)
+	
+	def scan(self, dates, wavelengths):
+		'''Find the AIA FITS files for all the specified dates and wavelengths, and return a dict of (date, wavelength) to the path of the file (or None)
+		Each directory implied by the AIA file pattern is listed only once, the file names are matched in memory'''
+		
+		directory_listings = dict()
+		candidates = dict()
+		
+		for date in dates:
+			for wavelength in wavelengths:
+				if (date, wavelength) not in self._aia_file_cache:
+					try:
+						candidates[(date, wavelength)] = self.get_candidate_files(self.aia_file_pattern.format(date=date, wavelength=wavelength), directory_listings)
+					except Exception as why:
+						# The files of the other dates and wavelengths can still be searched
+						logging.error('Could not search the AIA files for date %s and wavelength %s: %s', date, wavelength, why)
+						self._aia_file_cache[(date, wavelength)] = None
+						self._aia_file_errors[(date, wavelength)] = why
+		
+		if self._quality_executor is None:
+			for slot, file_paths in candidates.items():
+				self._set_AIA_file(slot, file_paths, self.select_good_quality_file(file_paths))
+		else:
+			# Check the first candidate of all the slots concurrently, then the second candidate of the slots that have no good file yet, etc.
+			# so that the result is the same as checking the candidates one by one
+			rank = 0
+			while candidates:
+				# The slots without candidates left have no good quality file
+				for slot in [slot for slot, file_paths in candidates.items() if rank >= len(file_paths)]:
+					self._set_AIA_file(slot, candidates.pop(slot), None)
+				
+				slots = list(candidates.keys())
+				qualities = self._quality_executor.map(self.get_indexed_quality, [candidates[slot][rank] for slot in slots])
+				for slot, quality in zip(slots, qualities):
+					if quality is None:
+						# The quality could not be read, the error is already logged
+						pass
+					elif self.is_good_quality(quality):
+						file_paths = candidates.pop(slot)
+						self._set_AIA_file(slot, file_paths, file_paths[rank])
+					else:
+						logging.debug('Skipping file %s with bad quality: %s', candidates[slot][rank], self.get_quality_errors(self.mask_ignored_bits(quality)))
+				rank += 1
+		
+		return {(date, wavelength): self._aia_file_cache[(date, wavelength)] for date in dates for wavelength in wavelengths}
+	
+	def get_good_quality_file(self, file_pattern, directory_listings = None):
 		'''Return the first file that matches the file_pattern and has a good quality'''
 		
-		for file_path in sorted(glob(file_pattern)):
-			
-			# Get the quality of the file
-			quality = self.get_quality(file_path)
-			
-			# Set the ignored quality bits to 0
-			for bit in self.ignore_quality_bits:
-				quality &= ~(1<<bit)
+		return self.select_good_quality_file(self.get_candidate_files(file_pattern, directory_listings))
+	
+	def select_good_quality_file(self, file_paths):
+		'''Return the first file of the list that has a good quality, the files whose quality cannot be read are skipped'''
+		
+		if self._quality_executor is None:
+			qualities = map(self.get_indexed_quality, file_paths)
+			futures = []
+		else:
+			# Check the quality of all the files concurrently, but look at the results in order
+			futures = [self._quality_executor.submit(self.get_indexed_quality, file_path) for file_path in file_paths]
+			qualities = (future.result() for future in futures)
+		
+		try:
+			for file_path, quality in zip(file_paths, qualities):
+				
+				# The quality could not be read, the error is already logged
+				if quality is None:
+					continue
+				
+				# Set the ignored quality bits to 0
+				quality = self.mask_ignored_bits(quality)
+				
+				# A quality of 0 means no defect
+				if quality == 0:
+					return file_path
+				else:
+					logging.debug('Skipping file %s with bad quality: %s', file_path, self.get_quality_errors(quality))
+		finally:
+			# Once the first good file is known, the remaining checks are useless
+			for future in futures:
+				future.cancel()
+	
+	def mask_ignored_bits(self, quality):
+		'''Return the quality with the ignored quality bits set to 0'''
+		
+		for bit in self.ignore_quality_bits:
+			quality &= ~(1<<bit)
+		
+		return quality
+	
+	def is_good_quality(self, quality):
+		'''Return True if the quality has no defect apart from the ignored quality bits'''
+		
+		return self.mask_ignored_bits(quality) == 0
+	
+	def get_candidate_files(self, file_pattern, directory_listings = None):
+		'''Return the sorted list of files that match the file_pattern
+		If a dict of directory listings is given, it is used and updated so that each directory is listed only once'''
+		
+		directory, name_pattern = os.path.split(file_pattern)
+		
+		# The directory listings can only be used if the wildcards are in the file name
+		if (self.index is None and directory_listings is None) or has_magic(directory):
+			return sorted(glob(file_pattern))
+		
+		if directory_listings is not None and directory in directory_listings:
+			names = directory_listings[directory]
+		else:
+			names = self.list_directory(directory)
+			if directory_listings is not None:
+				directory_listings[directory] = names
+		
+		# Like glob, ignore hidden files
+		return [os.path.join(directory, name) for name in names if fnmatchcase(name, name_pattern) and not name.startswith('.')]
+	
+	def list_directory(self, directory):
+		'''Return the sorted list of the names of the files in the directory'''
+		
+		if self.index is not None:
+			return self.index.list_directory(directory)
+		
+		try:
+			return sorted(os.listdir(directory))
+		except FileNotFoundError:
+			return []
+	
+	def get_indexed_quality(self, file_path):
+		'''Return the value of the quality keyword of the file from the index, or from the file if not yet indexed
+		If the quality cannot be read, e.g. the header is truncated, the error is logged and kept, and None is returned'''
+		
+		quality = self.index.get_quality(file_path) if self.index is not None else None
+		
+		if quality is None:
+			try:
+				quality = self.get_quality(file_path)
+			except Exception as why:
+				logging.error('Could not read quality of file %s: %s', file_path, why)
+				self._quality_errors[file_path] = why
+				return None
 			
-			# A quality of 0 means no defect
-			if quality == 0:
-				return file_path
-			else:
-				logging.debug('Skipping file %s with bad quality: %s', file_path, self.get_quality_errors(quality))
+			if self.index is not None:
+				self.index.set_quality(file_path, quality)
+		
+		return quality
 	
 	def get_quality(self, file_path):
 		'''Return the value of the quality keyword of the file'''
 		
-		with fits.open(file_path) as hdus:
-			return hdus[self.hdu].header[self.quality_keyword]
+		# Only the header is read, the image data is never loaded
+		return read_header_keywords(file_path, [self.quality_keyword], self.hdu)[self.quality_keyword]
 	
 	@classmethod
 	def get_quality_errors(cls, quality):
@@ -126,10 +289,12 @@ if __name__ == '__main__':
 	parser.add_argument('--ignore-quality-bits', '-I', metavar = 'QUALITY BIT NUMBER', type = int, action='append', help='The quality bits that can be ignored')
 	parser.add_argument('--hdu', '-H', type = int, help='The HDU number that contains the quality keyword')
 	parser.add_argument('--quality-keyword', '-K', metavar = 'KEYWORD', help='The name of the quality keyword')
+	parser.add_argument('--index-file', '-X', metavar = 'INDEX-FILE', help='The path to a SQLite file to keep an index of the files and their quality')
+	parser.add_argument('--quality-workers', '-W', type = int, help='The number of threads to check the quality of the files concurrently')
 	
 	args = parser.parse_args()
 	
-	sdo_data = SdoData(aia_file_pattern = args.aia_file_pattern, ignore_quality_bits = args.ignore_quality_bits, hdu = args.hdu, quality_keyword = args.quality_keyword)
+	sdo_data = SdoData(aia_file_pattern = args.aia_file_pattern, ignore_quality_bits = args.ignore_quality_bits, hdu = args.hdu, quality_keyword = args.quality_keyword, index_file = args.index_file, quality_workers = args.quality_workers)
 	
 	aia_file = sdo_data.get_AIA_file(args.date, args.wavelength)
 	
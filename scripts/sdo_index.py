@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+import os
+import logging
+import argparse
+import sqlite3
+import threading
+
+__all__ = ['SdoIndex']
+
+class SdoIndex:
+	'''Persistent index of the files in the SDO data directories and of their quality, stored in a SQLite database
+	A directory is only listed again when its modification time changed, and the quality of a file is forgotten when its modification time or size changed'''
+	
+	# Time in seconds to wait for the lock of the database held by another process
+	TIMEOUT = 60
+	
+	def __init__(self, database_file):
+		self.database_file = database_file
+		# The index can be used from several threads, so the access to the connection is serialized by a lock
+		self._lock = threading.Lock()
+		self._connection = sqlite3.connect(database_file, timeout = self.TIMEOUT, check_same_thread = False)
+		with self._lock, self._connection:
+			# The index is only a cache, it is fine to lose the last updates on a crash
+			self._connection.execute('PRAGMA synchronous = OFF')
+			self._connection.execute('CREATE TABLE IF NOT EXISTS directories (path TEXT PRIMARY KEY, mtime INTEGER NOT NULL)')
+			self._connection.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, directory TEXT NOT NULL, name TEXT NOT NULL, mtime INTEGER NOT NULL, size INTEGER NOT NULL, quality INTEGER)')
+			self._connection.execute('CREATE INDEX IF NOT EXISTS files_directory ON files (directory)')
+	
+	def list_directory(self, directory):
+		'''Return the sorted list of the names of the files in the directory'''
+		
+		try:
+			mtime = os.stat(directory).st_mtime_ns
+		except FileNotFoundError:
+			return []
+		
+		with self._lock:
+			row = self._connection.execute('SELECT mtime FROM directories WHERE path = ?', (directory,)).fetchone()
+			
+			if row is None or row[0] != mtime:
+				self._update_directory(directory, mtime)
+			
+			return [name for name, in self._connection.execute('SELECT name FROM files WHERE directory = ? ORDER BY name', (directory,))]
+	
+	def _update_directory(self, directory, mtime):
+		'''Update the files of the directory in the index, must be called with the lock held'''
+		
+		logging.debug('Updating index of directory %s', directory)
+		
+		files = dict()
+		with os.scandir(directory) as entries:
+			for entry in entries:
+				if entry.is_file():
+					stat = entry.stat()
+					files[entry.path] = (entry.name, stat.st_mtime_ns, stat.st_size)
+		
+		with self._connection:
+			indexed_files = {path: (name, mtime, size) for path, name, mtime, size in self._connection.execute('SELECT path, name, mtime, size FROM files WHERE directory = ?', (directory,))}
+			
+			# Remove the files that disappeared or changed, and add the new or changed ones
+			self._connection.executemany('DELETE FROM files WHERE path = ?', [(path,) for path in indexed_files if files.get(path) != indexed_files[path]])
+			self._connection.executemany('INSERT INTO files (path, directory, name, mtime, size) VALUES (?, ?, ?, ?, ?)', [(path, directory, name, mtime, size) for path, (name, mtime, size) in files.items() if indexed_files.get(path) != (name, mtime, size)])
+			self._connection.execute('INSERT OR REPLACE INTO directories (path, mtime) VALUES (?, ?)', (directory, mtime))
+	
+	def get_quality(self, file_path):
+		'''Return the quality of the file stored in the index, or None if it is not known'''
+		
+		with self._lock:
+			row = self._connection.execute('SELECT quality FROM files WHERE path = ?', (file_path,)).fetchone()
+		
+		return None if row is None else row[0]
+	
+	def set_quality(self, file_path, quality):
+		'''Store the quality of the file in the index'''
+		
+		with self._lock, self._connection:
+			self._connection.execute('UPDATE files SET quality = ? WHERE path = ?', (quality, file_path))
+	
+	def close(self):
+		with self._lock:
+			self._connection.close()
+
+
+# Start point of the script
+if __name__ == '__main__':
+	
+	parser = argparse.ArgumentParser(description='Update and print the index of the files in SDO data directories')
+	parser.add_argument('database_file', metavar = 'INDEX-FILE', help = 'The path to the SQLite index file')
+	parser.add_argument('directories', metavar = 'DIRECTORY', nargs = '+', help = 'A directory to index')
+	
+	args = parser.parse_args()
+	
+	sdo_index = SdoIndex(args.database_file)
+	
+	for directory in args.directories:
+		for name in sdo_index.list_directory(directory):
+			file_path = os.path.join(directory, name)
+			print(file_path, sdo_index.get_quality(file_path))
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+from collections import OrderedDict
+import numpy
+
+__all__ = ['SolarDiskMasks']
+
+class SolarDiskMasks:
+	'''Provider of masks of the solar disk, the pixels for which (i - row_center)**2 + (j - column_center)**2 <= radius**2
+	As the disk is convex, it is stored as the range of columns of the disk in each row, and the masks are built band by band from the row ranges
+	The row ranges are cached in a bounded LRU, keyed by the shape and the rounded center and radius, because consecutive images have nearly the same geometry'''
+	
+	# Maximal number of row ranges kept in the cache
+	CACHE_SIZE = 8
+	
+	# Default number of decimals of the center and radius (in pixels) used as cache key
+	DECIMALS = 2
+	
+	# Number of rows of the mask computed at once, so that the temporary arrays stay small
+	BAND_SIZE = 256
+	
+	def __init__(self, cache_size = None, decimals = None):
+		self.cache_size = self.CACHE_SIZE if cache_size is None else cache_size
+		self.decimals = self.DECIMALS if decimals is None else decimals
+		self._cache = OrderedDict()
+	
+	def get_mask(self, shape, row_center, column_center, radius, rows = slice(None), outside = False):
+		'''Return a boolean array for the rows of the specified shape that is True for the pixels on the solar disk, or outside of it'''
+		
+		starts, stops = self.get_row_ranges(shape, row_center, column_center, radius)
+		
+		columns = numpy.arange(shape[1])
+		
+		if outside:
+			return (columns < starts[rows, numpy.newaxis]) | (columns >= stops[rows, numpy.newaxis])
+		else:
+			return (columns >= starts[rows, numpy.newaxis]) & (columns < stops[rows, numpy.newaxis])
+	
+	def get_row_ranges(self, shape, row_center, column_center, radius):
+		'''Return 2 read-only arrays with for each row the start and stop column of the pixels on the solar disk
+		Rows that do not cross the disk have a start and stop of 0'''
+		
+		shape = tuple(shape)
+		row_center = round(row_center, self.decimals)
+		column_center = round(column_center, self.decimals)
+		radius = round(radius, self.decimals)
+		
+		key = (shape, row_center, column_center, radius)
+		
+		if key in self._cache:
+			self._cache.move_to_end(key)
+		else:
+			self._cache[key] = self._compute(shape, row_center, column_center, radius)
+			if len(self._cache) > self.cache_size:
+				self._cache.popitem(last = False)
+		
+		return self._cache[key]
+	
+	def _compute(self, shape, row_center, column_center, radius):
+		'''Compute the row ranges of the solar disk'''
+		
+		# The squared distances are computed separately for the rows and the columns and combined by broadcasting, band by band
+		rows_distance = numpy.arange(shape[0]) - row_center
+		rows_distance *= rows_distance
+		columns_distance = numpy.arange(shape[1]) - column_center
+		columns_distance *= columns_distance
+		
+		starts = numpy.zeros(shape[0], dtype = numpy.intp)
+		stops = numpy.zeros(shape[0], dtype = numpy.intp)
+		
+		for start in range(0, shape[0], self.BAND_SIZE):
+			stop = start + self.BAND_SIZE
+			band_mask = numpy.less_equal(rows_distance[start:stop, numpy.newaxis] + columns_distance, radius * radius)
+			
+			# The disk is convex, so the disk pixels of a row are contiguous
+			counts = numpy.count_nonzero(band_mask, axis = 1)
+			starts[start:stop] = numpy.where(counts > 0, numpy.argmax(band_mask, axis = 1), 0)
+			stops[start:stop] = starts[start:stop] + counts
+		
+		for array in (starts, stops):
+			array.setflags(write = False)
+		
+		return starts, stops
@@ -1,53 +1,180 @@
 #!/usr/bin/env python3
+import os
+import bisect
+import shutil
+import logging
+import uuid
 from pathlib import Path
+from functools import partial
 
 from job import Job, JobError
 
-__all__ = ['SegmentationJob', 'GetStaffStatsJob']
+__all__ = ['CentersStore', 'SegmentationJob', 'GetStaffStatsJob']
+
+class CentersStore:
+	'''Snapshots of the class centers file of the SPoCA classification, one per processed date
+	Each classification runs on its own working copy of the centers, seeded from the snapshot of the nearest earlier date (nearest seeding),
+	or always from the reference centers file (reference seeding), and the working copy becomes the snapshot of the date only if the classification succeeded
+	With the reference seeding the result of a date does not depend on the other dates, so dates can be processed in any order or concurrently'''
+	
+	# The seeding policies
+	SEEDINGS = ['nearest', 'reference']
+	
+	def __init__(self, directory, reference_file = None, seeding = 'nearest'):
+		if seeding not in self.SEEDINGS:
+			raise ValueError('Unknown centers seeding %s' % seeding)
+		self.directory = Path(directory)
+		self.directory.mkdir(parents = True, exist_ok = True)
+		self.reference_file = Path(reference_file) if reference_file else None
+		self.seeding = seeding
+	
+	def get_snapshot_file(self, date):
+		'''Return the path of the snapshot of the centers for the date'''
+		return self.directory / (date.strftime('%Y%m%d_%H%M%S') + '.centers.txt')
+	
+	def get_seed_file(self, date):
+		'''Return the path of the centers file to start the classification of the date from, or None if there is none'''
+		
+		if self.seeding == 'nearest':
+			# The names of the snapshots sort like their dates
+			snapshot_names = sorted(path.name for path in self.directory.glob('*.centers.txt'))
+			index = bisect.bisect_left(snapshot_names, self.get_snapshot_file(date).name)
+			if index > 0:
+				return self.directory / snapshot_names[index - 1]
+		
+		if self.reference_file is not None and self.reference_file.is_file():
+			return self.reference_file
+		
+		return None
+	
+	def checkout(self, date):
+		'''Return the path of a new working copy of the centers for the classification of the date'''
+		
+		working_file = self.directory / ('.%s.%s.tmp' % (self.get_snapshot_file(date).name, uuid.uuid4().hex))
+		seed_file = self.get_seed_file(date)
+		
+		# Without a seed, the working copy does not exist and the classification starts from scratch
+		if seed_file is not None:
+			logging.debug('Seeding centers for date %s from %s', date, seed_file)
+			shutil.copyfile(seed_file, working_file)
+		
+		return working_file
+	
+	def commit(self, date, working_file):
+		'''Make the working copy the snapshot of the centers for the date'''
+		if working_file.exists():
+			os.replace(working_file, self.get_snapshot_file(date))
+	
+	def discard(self, working_file):
+		'''Remove the working copy of a failed classification'''
+		if working_file.exists():
+			working_file.unlink()
+
 
 class SegmentationJob(Job):
-	'''Job to execute the SPoCA classification executable to get a segmentation map'''
+	'''Job to execute the SPoCA classification executable to get a segmentation map
+	If a CentersStore is given, each classification uses a snapshot of the centers for its date instead of the shared centers file'''
 	
-	def __init__(self, executable, config_file, centers_file):
+	def __init__(self, executable, config_file, centers_file, timeout = None, output_logger = None, centers_store = None):
 		optional_parameters = {
 			'config' : config_file,
 			'centersFile' : centers_file
 		}
-		super().__init__(executable, optional_parameters = optional_parameters)
+		super().__init__(executable, optional_parameters = optional_parameters, timeout = timeout, output_logger = output_logger)
+		self.centers_store = centers_store
 	
-	def execute(self, aia_images, output_file):
+	def execute(self, aia_images, output_file, date = None):
 		'''Execute the SPoCA classification on the specified AIA images'''
 		
+		return self.start(aia_images, output_file, date).wait()
+	
+	def start(self, aia_images, output_file, date = None):
+		'''Start the SPoCA classification on the specified AIA images in the background, the wait method of the returned job raises a JobError on failure
+		The date is required if there is a centers store'''
+		
 		optional_parameters = {
 			'output': output_file
 		}
 		
-		exit_code, output, error = super().execute(positional_parameters = aia_images, optional_parameters = optional_parameters)
+		centers_file = None
+		if self.centers_store is not None:
+			if date is None:
+				raise ValueError('The date is required to use the centers store')
+			centers_file = self.centers_store.checkout(date)
+			optional_parameters['centersFile'] = centers_file
 		
-		# Check if the job ran succesfully
-		if exit_code != 0:
-			raise JobError(self.executable, exit_code, output, error, aia_images = aia_images)
+		return super().start(positional_parameters = aia_images, optional_parameters = optional_parameters, check = partial(self.check_result, aia_images = aia_images, output_file = output_file, date = date, centers_file = centers_file))
+	
+	def check_result(self, exit_code, output, error, aia_images, output_file, date = None, centers_file = None):
+		'''Raise a JobError if the SPoCA classification failed, else commit the centers to the centers store'''
+		
+		try:
+			# Check if the job ran succesfully
+			if exit_code != 0:
+				raise JobError(self.executable, exit_code, output, error, aia_images = aia_images)
+			
+			# Check if the output file was actually created
+			if not Path(output_file).is_file():
+				raise JobError(self.executable, exit_code, output, error, message = 'Could not find output file {output_file}', output_file = output_file)
+		except JobError:
+			if centers_file is not None:
+				self.centers_store.discard(centers_file)
+			raise
 		
-		# Check if the output file was actually created
-		if not Path(output_file).is_file():
-			raise JobError(self.executable, exit_code, output, error, message = 'Could not find output file {output_file}', output_file = output_file)
+		if centers_file is not None:
+			self.centers_store.commit(date, centers_file)
 
 
 class GetStaffStatsJob(Job):
-	'''Job to execute the classification SPoCA executable to get a STAFF statitics file'''
+	'''Job to execute the classification SPoCA executable to get a STAFF statitics file
+	The name of the statistics file is chosen by get_STAFF_stats, so it is found by comparing the files of the output directory before and after the run
+	When several dates are processed concurrently, the files written in the meantime for the other dates can be found too'''
 	
-	def __init__(self, executable, config_file, output_directory):
+	def __init__(self, executable, config_file, output_directory, timeout = None, output_logger = None):
 		optional_parameters = {
 			'config' : config_file,
 			'output' : output_directory
 		}
-		super().__init__(executable, optional_parameters = optional_parameters)
+		super().__init__(executable, optional_parameters = optional_parameters, timeout = timeout, output_logger = output_logger)
+		self.output_directory = Path(output_directory)
 	
 	def execute(self, ar_segmentation_map, ch_segmentation_map, sun_images):
-		'''Execute the SPoCA get_STAFF_stats on the specified AR and CH segmentation maps and extract the statistics for the specified images'''
+		'''Execute the SPoCA get_STAFF_stats on the specified AR and CH segmentation maps and extract the statistics for the specified images, and return the list of statistics files written'''
+		
+		output_files = self.list_output_files()
+		self.start(ar_segmentation_map, ch_segmentation_map, sun_images, output_files).wait()
+		return self.get_new_output_files(output_files)
+	
+	def start(self, ar_segmentation_map, ch_segmentation_map, sun_images, output_files = None):
+		'''Start the SPoCA get_STAFF_stats in the background, the wait method of the returned job raises a JobError on failure
+		The output files are the listing of the output directory before the run, by default it is listed now'''
 		
-		exit_code, output, error = super().execute(positional_parameters = [ar_segmentation_map, ch_segmentation_map] + sun_images)
+		if output_files is None:
+			output_files = self.list_output_files()
+		
+		return super().start(positional_parameters = [ar_segmentation_map, ch_segmentation_map] + sun_images, check = partial(self.check_result, ar_segmentation_map = ar_segmentation_map, ch_segmentation_map = ch_segmentation_map, output_files = output_files))
+	
+	def check_result(self, exit_code, output, error, ar_segmentation_map, ch_segmentation_map, output_files = None):
+		'''Raise a JobError if the SPoCA get_STAFF_stats failed'''
 		
 		# Check if the job ran succesfully
 		if exit_code != 0:
 			raise JobError(self.executable, exit_code, output, error, ar_segmentation_map = ar_segmentation_map, ch_segmentation_map = ch_segmentation_map)
+		
+		# Check if an output file was actually written
+		if output_files is not None and not self.get_new_output_files(output_files):
+			raise JobError(self.executable, exit_code, output, error, message = 'Could not find output file in {output_directory}', output_directory = self.output_directory)
+	
+	def list_output_files(self):
+		'''Return a dict of the names of the files in the output directory to their modification time, size and inode'''
+		
+		try:
+			with os.scandir(self.output_directory) as entries:
+				return {entry.name: (entry.stat().st_mtime_ns, entry.stat().st_size, entry.inode()) for entry in entries if entry.is_file()}
+		except FileNotFoundError:
+			return {}
+	
+	def get_new_output_files(self, output_files):
+		'''Return the sorted list of the paths of the files of the output directory that were created or modified since the listing output_files'''
+		
+		return [self.output_directory / name for name, state in sorted(self.list_output_files().items()) if output_files.get(name) != state]
@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+import os
+import time
+import uuid
+import fcntl
+import logging
+import argparse
+from datetime import datetime
+from pathlib import Path
+
+# Only the Parquet store requires pandas, so the csv store can be used without it
+try:
+	import pandas
+except ImportError:
+	pandas = None
+
+__all__ = ['write_image_stats', 'CsvStatsStore', 'ParquetStatsStore', 'get_stats_store']
+
+def write_image_stats(filepath, stats):
+	'''Write a csv file with a dict of stats (legacy code)'''
+	headers = sorted(stats.keys())
+	with open(filepath, 'tw') as file:
+		file.write(','.join(headers) + '\n')
+		file.write(','.join([format_stat(stats[header]) for header in headers]) + '\n')
+
+
+def format_stat(value):
+	'''Format a statistic value like the legacy csv files'''
+	return '%.3f' % value if isinstance(value, float) else str(value)
+
+
+class CsvStatsStore:
+	'''Store the statistics of each image in a separate csv file (legacy format)'''
+	
+	def __init__(self, directory):
+		self.directory = Path(directory)
+	
+	def get_csv_file(self, image_name):
+		'''Return the path to the csv file for the statistics of the image'''
+		return self.directory / Path(image_name).with_suffix('.csv').name
+	
+	def get_output_file(self, image_name, stats):
+		'''Return the path to the file that contains the statistics of the image once they are written'''
+		return self.get_csv_file(image_name)
+	
+	def append(self, image_name, stats):
+		'''Write the statistics of the image'''
+		csv_file = self.get_csv_file(image_name)
+		logging.debug('Writing statistics for image %s to file %s', image_name, csv_file)
+		write_image_stats(csv_file, stats)
+	
+	@property
+	def pending_count(self):
+		'''The number of appended statistics not yet written, always 0 as they are written immediately'''
+		return 0
+	
+	def close(self):
+		pass
+
+
+class ParquetStatsStore:
+	'''Store the statistics of the images in Parquet files partitioned by wavelength and month of observation
+	Appended rows are buffered and written as new fragment files, that are merged into the main file of each partition by the compaction
+	All files are written to a temporary file and renamed, so readers never see a partial file (requires pandas with pyarrow)'''
+	
+	# Number of rows to buffer before writing a fragment
+	BUFFER_SIZE = 1000
+	
+	# Name of the main file of a partition
+	DATA_FILE = 'data.parquet'
+	
+	def __init__(self, directory, buffer_size = None):
+		if pandas is None:
+			raise ImportError('The Parquet store requires pandas with pyarrow')
+		self.directory = Path(directory)
+		self.buffer_size = self.BUFFER_SIZE if buffer_size is None else buffer_size
+		self._rows = list()
+		self._partitions = set()
+	
+	def get_partition(self, stats):
+		'''Return the directory of the partition for the statistics'''
+		return self.directory / ('%04d' % int(stats['WAVELENGTH'])) / str(stats['DATE_OBS'])[:7]
+	
+	def get_output_file(self, image_name, stats):
+		'''Return the path to the file that contains the statistics of the image once the store is closed, the main file of its partition'''
+		return self.get_partition(stats) / self.DATA_FILE
+	
+	def append(self, image_name, stats):
+		'''Add the statistics of the image to the store'''
+		self._rows.append({'IMAGE': Path(image_name).name, **stats})
+		if len(self._rows) >= self.buffer_size:
+			self.flush()
+	
+	@property
+	def pending_count(self):
+		'''The number of appended statistics not yet written to a fragment'''
+		return len(self._rows)
+	
+	def flush(self):
+		'''Write the buffered rows as new fragments of their partition'''
+		
+		if not self._rows:
+			return
+		
+		dataframe = pandas.DataFrame(self._rows)
+		self._rows = list()
+		
+		for partition, partition_dataframe in dataframe.groupby(dataframe.apply(self.get_partition, axis = 1)):
+			partition.mkdir(parents = True, exist_ok = True)
+			# The name of the fragments sort in the order they were written
+			fragment = partition / ('part-%d-%s.parquet' % (time.time_ns(), uuid.uuid4().hex))
+			logging.debug('Writing %s rows to fragment %s', len(partition_dataframe), fragment)
+			self._write(partition_dataframe, fragment)
+			self._partitions.add(partition)
+	
+	def close(self):
+		'''Write the buffered rows and compact the partitions that were modified'''
+		self.flush()
+		for partition in self._partitions:
+			self.compact_partition(partition)
+		self._partitions.clear()
+	
+	def compact(self):
+		'''Merge the fragments of all the partitions into their main file'''
+		for partition in self.directory.glob('*/*'):
+			if partition.is_dir():
+				self.compact_partition(partition)
+	
+	def compact_partition(self, partition):
+		'''Merge the fragments of the partition into its main file'''
+		
+		# Only one process at a time can compact a partition, but appending new fragments is always possible
+		with open(partition / '.lock', 'w') as lock:
+			fcntl.flock(lock, fcntl.LOCK_EX)
+			
+			fragments = sorted(partition.glob('part-*.parquet'))
+			if not fragments:
+				return
+			
+			logging.debug('Compacting %s fragments of partition %s', len(fragments), partition)
+			self._write(self._read_partition(partition, fragments), partition / self.DATA_FILE)
+			
+			# If the process stops before all fragments are removed, the duplicates are dropped at the next read
+			for fragment in fragments:
+				fragment.unlink()
+	
+	def read(self, wavelengths = None, start_date = None, end_date = None):
+		'''Return a DataFrame with the statistics of the images for the specified wavelengths and observation dates'''
+		
+		dataframes = list()
+		
+		for partition in sorted(self.directory.glob('*/*')):
+			if not partition.is_dir():
+				continue
+			if wavelengths is not None and int(partition.parent.name) not in wavelengths:
+				continue
+			if start_date is not None and partition.name < start_date.strftime('%Y-%m'):
+				continue
+			if end_date is not None and partition.name > end_date.strftime('%Y-%m'):
+				continue
+			# A compaction removes the fragments, so it must not happen while they are read
+			with open(partition / '.lock', 'w') as lock:
+				fcntl.flock(lock, fcntl.LOCK_SH)
+				dataframes.append(self._read_partition(partition))
+		
+		if not dataframes:
+			return pandas.DataFrame()
+		
+		dataframe = pandas.concat(dataframes, ignore_index = True)
+		
+		# Partitions are by month, so the dates must be filtered more precisely
+		dates = pandas.to_datetime(dataframe['DATE_OBS'], utc = True, format = 'ISO8601').dt.tz_localize(None)
+		selected = pandas.Series(True, index = dataframe.index)
+		if start_date is not None:
+			selected &= dates >= start_date
+		if end_date is not None:
+			selected &= dates < end_date
+		
+		return dataframe[selected]
+	
+	def export_csv(self, output_directory, wavelengths = None, start_date = None, end_date = None):
+		'''Write the statistics of the images in separate csv files, like the legacy format'''
+		
+		csv_store = CsvStatsStore(output_directory)
+		csv_store.directory.mkdir(parents = True, exist_ok = True)
+		
+		for record in self.read(wavelengths, start_date, end_date).to_dict('records'):
+			image_name = record.pop('IMAGE')
+			csv_store.append(image_name, record)
+	
+	def _read_partition(self, partition, fragments = None):
+		'''Return a DataFrame with the rows of the main file and the fragments of a partition, without duplicated images'''
+		
+		if fragments is None:
+			fragments = sorted(partition.glob('part-*.parquet'))
+		
+		files = [partition / self.DATA_FILE] if (partition / self.DATA_FILE).exists() else []
+		dataframe = pandas.concat([pandas.read_parquet(file) for file in files + fragments], ignore_index = True)
+		
+		# If an image was processed again, keep the latest statistics
+		return dataframe.drop_duplicates('IMAGE', keep = 'last').sort_values('DATE_OBS', ignore_index = True)
+	
+	@staticmethod
+	def _write(dataframe, file_path):
+		'''Write the dataframe to a parquet file atomically'''
+		temporary_file = file_path.with_name('.%s.%s.tmp' % (file_path.name, uuid.uuid4().hex))
+		try:
+			dataframe.to_parquet(temporary_file, index = False)
+			os.replace(temporary_file, file_path)
+		finally:
+			if temporary_file.exists():
+				temporary_file.unlink()
+
+
+def get_stats_store(output_format, directory):
+	'''Return the store of image statistics for the output format'''
+	if output_format == 'csv':
+		return CsvStatsStore(directory)
+	elif output_format == 'parquet':
+		return ParquetStatsStore(directory)
+	else:
+		raise ValueError('Unknown output format %s' % output_format)
+
+
+# Start point of the script
+if __name__ == '__main__':
+	
+	parser = argparse.ArgumentParser(description='Manage a Parquet store of images statistics')
+	parser.add_argument('--verbose', '-v', choices = ['DEBUG', 'INFO', 'ERROR'], default = 'INFO', help='Set the logging level (default is INFO)')
+	parser.add_argument('directory', metavar = 'STORE-DIRECTORY', help = 'The directory of the Parquet store')
+	subparsers = parser.add_subparsers(dest = 'command', required = True)
+	subparsers.add_parser('compact', help = 'Merge the fragments of the partitions')
+	export_parser = subparsers.add_parser('export', help = 'Write the statistics of each image to a legacy csv file')
+	export_parser.add_argument('--output-dir', '-o', default = '.', type = Path, help = 'The directory where to write the csv files')
+	export_parser.add_argument('--wavelength', '-w', nargs = '+', type = int, help = 'The AIA wavelengths to export')
+	export_parser.add_argument('--start-date', '-s', type = datetime.fromisoformat, help = 'Start date of observation (ISO 8601 format)')
+	export_parser.add_argument('--end-date', '-e', type = datetime.fromisoformat, help = 'End date of observation (ISO 8601 format)')
+	
+	args = parser.parse_args()
+	
+	# Setup the logging
+	logging.basicConfig(level = getattr(logging, args.verbose), format = '%(asctime)s %(levelname)-8s: %(message)s')
+	
+	store = ParquetStatsStore(args.directory)
+	
+	if args.command == 'compact':
+		store.compact()
+	else:
+		store.export_csv(args.output_dir, args.wavelength, args.start_date, args.end_date)
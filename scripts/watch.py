@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+import time
+import logging
+from datetime import datetime
+
+__all__ = ['DateWatcher']
+
+class DateWatcher:
+	'''Watcher of the AIA files of the dates from start_date to end_date (forever if None) every interval, that tells when the dates can be processed
+	A date is ready as soon as a good quality file is found for all the wavelengths, or once the grace period has passed since its first file was found (at the latest since the next date), so that a late channel does not hold the processing
+	The AIA files are searched by the scan of the sdo_data, so each directory is listed only once per poll'''
+	
+	def __init__(self, sdo_data, wavelengths, start_date, interval, grace_period, end_date = None):
+		self.sdo_data = sdo_data
+		self.wavelengths = wavelengths
+		self.interval = interval
+		self.grace_period = grace_period
+		self.end_date = end_date
+		self._next_date = start_date
+		self._pending = list()
+		self._ready = list()
+		self._first_seen = dict()
+	
+	@property
+	def finished(self):
+		'''True if all the dates before the end date were ready'''
+		return self.end_date is not None and self._next_date >= self.end_date and not self._pending
+	
+	def poll(self, now = None):
+		'''Search the files of the pending dates, and return the sorted list of the dates that are ready'''
+		
+		if now is None:
+			now = datetime.utcnow()
+		
+		# A date is pending once it has passed
+		while self._next_date <= now and (self.end_date is None or self._next_date < self.end_date):
+			self._pending.append(self._next_date)
+			self._next_date += self.interval
+		
+		# The files of the dates already processed are not needed anymore, and the missing files must be searched again
+		self.sdo_data.clear_cache(set(self._ready))
+		self.sdo_data.clear_cache(set(self._pending), missing_only = True)
+		self._ready = list()
+		
+		if not self._pending:
+			return self._ready
+		
+		# The files that cannot be read are missing for the scan, so they do not hold the date longer than the grace period
+		aia_files = dict()
+		try:
+			aia_files.update(self.sdo_data.scan(self._pending, self.wavelengths))
+		except Exception as why:
+			# The dates are searched again one by one, so that an error for one date does not hold the others
+			logging.error('Error searching the AIA files from date %s to %s: %s', self._pending[0], self._pending[-1], why)
+			for date in self._pending:
+				try:
+					aia_files.update(self.sdo_data.scan([date], self.wavelengths))
+				except Exception as why:
+					# The files of the date are searched again at the next poll, they are missing until then
+					logging.error('Error searching the AIA files of date %s: %s', date, why)
+		
+		for date in self._pending:
+			missing_wavelengths = [wavelength for wavelength in self.wavelengths if aia_files.get((date, wavelength)) is None]
+			
+			if len(missing_wavelengths) < len(self.wavelengths):
+				self._first_seen.setdefault(date, now)
+			
+			if not missing_wavelengths:
+				logging.debug('All the AIA files of date %s were found', date)
+				self._ready.append(date)
+			elif now - min(self._first_seen.get(date, now), date + self.interval) >= self.grace_period:
+				logging.warning('AIA files of date %s for wavelengths %s still missing after the grace period, processing without them', date, missing_wavelengths)
+				self._ready.append(date)
+		
+		for date in self._ready:
+			self._pending.remove(date)
+			self._first_seen.pop(date, None)
+		
+		return self._ready
+	
+	def watch(self, poll_interval):
+		'''Generator of the sorted lists of dates that are ready, polling every poll_interval seconds until finished'''
+		
+		while not self.finished:
+			dates = self.poll()
+			if dates:
+				yield dates
+			else:
+				time.sleep(poll_interval)
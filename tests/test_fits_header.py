@@ -0,0 +1,67 @@
+import os
+import sys
+import gzip
+
+import numpy
+import pytest
+from astropy.io import fits
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scripts'))
+
+from fits_header import read_header_keywords, read_files_header_keywords
+
+KEYWORDS = ['QUALITY', 'T_OBS', 'EXPTIME', 'WAVELNTH']
+
+
+def write_fits_file(file_path, compressed = False):
+	'''Write a FITS file with an image and keywords like an AIA file, tile compressed in a second HDU or uncompressed in the primary HDU'''
+
+	header = fits.Header()
+	header['QUALITY'] = 1073741824
+	header['T_OBS'] = '2020-01-01T00:00:04.84Z'
+	header['EXPTIME'] = 2.000172
+	header['WAVELNTH'] = 171
+	# Many keywords, so that the header spans several blocks
+	for number in range(100):
+		header['KEY%d' % number] = number
+
+	data = numpy.arange(64 * 64, dtype = numpy.int16).reshape(64, 64)
+
+	if compressed:
+		hdus = fits.HDUList([fits.PrimaryHDU(), fits.CompImageHDU(data, header)])
+	else:
+		hdus = fits.HDUList([fits.PrimaryHDU(data, header)])
+
+	hdus.writeto(file_path)
+
+
+@pytest.mark.parametrize('compressed, hdu', [(False, 0), (True, 1)])
+def test_read_header_keywords(tmp_path, compressed, hdu):
+	file_path = tmp_path / 'image.fits'
+	write_fits_file(file_path, compressed)
+
+	values = read_header_keywords(file_path, KEYWORDS + ['MISSING'], hdu)
+
+	with fits.open(file_path) as hdus:
+		assert values == {keyword: hdus[hdu].header[keyword] for keyword in KEYWORDS}
+
+
+def test_read_header_keywords_gzip(tmp_path):
+	file_path = tmp_path / 'image.fits'
+	write_fits_file(file_path)
+	with open(file_path, 'rb') as file, gzip.open(tmp_path / 'image.fits.gz', 'wb') as gzip_file:
+		gzip_file.write(file.read())
+
+	assert read_header_keywords(tmp_path / 'image.fits.gz', KEYWORDS) == read_header_keywords(file_path, KEYWORDS)
+
+
+def test_read_header_keywords_truncated(tmp_path):
+	file_path = tmp_path / 'image.fits'
+	write_fits_file(file_path)
+	with open(file_path, 'r+b') as file:
+		file.truncate(1000)
+
+	with pytest.raises(ValueError):
+		read_header_keywords(file_path, KEYWORDS)
+
+	assert read_files_header_keywords([file_path], KEYWORDS) == {file_path: None}
@@ -0,0 +1,85 @@
+import os
+import sys
+
+import numpy
+import pytest
+from astropy.io import fits
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scripts'))
+
+from get_image_stats import get_image_stats, PERCENTILES
+
+
+def write_aia_file(file_path, compressed = False):
+	'''Write a small FITS file with the keywords of an AIA image used for the statistics'''
+
+	image = numpy.random.default_rng(0).lognormal(3, 1.5, (120, 100)).astype(numpy.float32)
+
+	header = fits.Header()
+	header['T_OBS'] = '2020-01-01T00:00:04.84Z'
+	header['WAVELNTH'] = 171
+	header['RSUN_OBS'] = 40.
+	header['CDELT1'] = 1.
+	header['CRPIX1'] = 55.3
+	header['CRPIX2'] = 48.7
+	header['EXPTIME'] = 2.000172
+
+	# The tile compression of floats does not keep the NaN without quantization
+	if compressed:
+		fits.HDUList([fits.PrimaryHDU(), fits.CompImageHDU(image, header, quantize_level = 0)]).writeto(file_path)
+	else:
+		image[7, 3] = numpy.nan
+		fits.HDUList([fits.PrimaryHDU(image, header)]).writeto(file_path)
+
+
+def get_legacy_stats(file_path, hdu):
+	'''Return the statistics computed like the legacy code, with the whole image in memory and numpy'''
+
+	with fits.open(file_path) as hdus:
+		header = hdus[hdu].header
+		image = hdus[hdu].data / float(header['EXPTIME'])
+
+	solar_radius = header['RSUN_OBS'] / header['CDELT1']
+	x, y = numpy.indices(image.shape, dtype = numpy.float64)
+	x -= image.shape[0] - (header['CRPIX1'] - 1)
+	y -= header['CRPIX2'] - 1
+	disk = numpy.ma.masked_less_equal(x * x + y * y, solar_radius * solar_radius)
+
+	stats = dict()
+	for prefix, pixels in [('DATA', image[numpy.isfinite(image)]), ('DISK', image[numpy.isfinite(image) & ~disk.mask])]:
+		stats[prefix + 'MIN'] = pixels.min()
+		stats[prefix + 'MAX'] = pixels.max()
+		stats[prefix + 'MEAN'] = pixels.mean(dtype = numpy.float64)
+		stats[prefix + 'RMS'] = pixels.std(dtype = numpy.float64)
+		stats[prefix + 'TOTL'] = pixels.sum(dtype = numpy.float64)
+		for key, percentile in zip(PERCENTILES.keys(), numpy.percentile(pixels, list(PERCENTILES.values()))):
+			stats[prefix + key] = percentile
+	return stats
+
+
+@pytest.mark.parametrize('compressed, hdu, band_size', [(False, 0, None), (False, 0, 7), (True, 1, None), (True, 1, 16)])
+def test_get_image_stats_matches_legacy(tmp_path, compressed, hdu, band_size):
+	file_path = tmp_path / 'image.fits'
+	write_aia_file(file_path, compressed)
+
+	stats = get_image_stats(file_path, hdu, band_size = band_size)
+	legacy_stats = get_legacy_stats(file_path, hdu)
+
+	assert stats['DATE_OBS'] == '2020-01-01T00:00:04.84Z'
+	assert stats['WAVELENGTH'] == 171
+	for key, value in legacy_stats.items():
+		assert round(stats[key], 3) == pytest.approx(round(float(value), 3), abs = 1e-3), key
+
+
+def test_get_image_stats_sketch(tmp_path):
+	accuracy = 0.001
+	file_path = tmp_path / 'image.fits'
+	write_aia_file(file_path)
+
+	stats = get_image_stats(file_path, 0, band_size = 7, percentile_engine = 'sketch', percentile_accuracy = accuracy)
+	legacy_stats = get_legacy_stats(file_path, 0)
+
+	for prefix in ['DATA', 'DISK']:
+		for key in PERCENTILES.keys():
+			exact = legacy_stats[prefix + key]
+			assert abs(stats[prefix + key] - exact) <= accuracy * abs(exact) * (1 + 1e-6), prefix + key
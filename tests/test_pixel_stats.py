@@ -0,0 +1,157 @@
+import os
+import sys
+
+import numpy
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scripts'))
+
+from pixel_stats import PixelStats, QuantileSketch, SplitStats
+
+PERCENTILES = [0, 1, 10, 25, 50, 75, 90, 99, 100]
+
+
+def get_pixels(size = 10000, seed = 0):
+	'''Return positive pixel values with a long tail, like the values of an AIA image'''
+	return numpy.random.default_rng(seed).lognormal(3, 1.5, size)
+
+
+def get_moments(pixels):
+	'''Return the reference biased skewness and excess kurtosis of the pixels'''
+	deviations = pixels - pixels.mean()
+	m2 = numpy.mean(deviations**2)
+	return numpy.mean(deviations**3) / m2**1.5, numpy.mean(deviations**4) / m2**2 - 3
+
+
+def test_pixel_stats_update_in_parts():
+	pixels = get_pixels()
+
+	pixel_stats = PixelStats()
+	for part in numpy.array_split(pixels, 7):
+		pixel_stats.update(part)
+
+	assert pixel_stats.count == pixels.size
+	assert pixel_stats.min == pixels.min()
+	assert pixel_stats.max == pixels.max()
+	assert pixel_stats.mean == pytest.approx(pixels.mean(), rel = 1e-12)
+	assert pixel_stats.std == pytest.approx(pixels.std(), rel = 1e-12)
+	assert pixel_stats.sum == pytest.approx(pixels.sum(), rel = 1e-12)
+
+
+def test_pixel_stats_merge_higher_moments(monkeypatch):
+	pixels = get_pixels()
+	skewness, kurtosis = get_moments(pixels)
+
+	# Parts of different sizes and means, larger than the chunk size, so that the merges of the chunks and of the accumulators are both used
+	monkeypatch.setattr(PixelStats, 'CHUNK_SIZE', 1000)
+	parts = [PixelStats(higher_moments = True).update(part) for part in numpy.split(numpy.sort(pixels), [10, 3000, 3001, 8000])]
+
+	pixel_stats = PixelStats(higher_moments = True)
+	for part in parts:
+		pixel_stats.merge(part)
+
+	assert pixel_stats.count == pixels.size
+	assert pixel_stats.mean == pytest.approx(pixels.mean(), rel = 1e-12)
+	assert pixel_stats.std == pytest.approx(pixels.std(), rel = 1e-10)
+	assert pixel_stats.skewness == pytest.approx(skewness, rel = 1e-9)
+	assert pixel_stats.kurtosis == pytest.approx(kurtosis, rel = 1e-9)
+
+
+def test_pixel_stats_merge_empty_and_without_higher_moments():
+	pixels = get_pixels(100)
+
+	pixel_stats = PixelStats().merge(PixelStats()).merge(PixelStats().update(pixels))
+
+	assert pixel_stats.count == pixels.size
+	assert pixel_stats.mean == pytest.approx(pixels.mean())
+
+	with pytest.raises(ValueError):
+		PixelStats(higher_moments = True).merge(PixelStats().update(pixels))
+
+
+@pytest.mark.parametrize('accuracy', [0.01, 0.001])
+def test_quantile_sketch_relative_error(accuracy):
+	pixels = get_pixels()
+
+	sketch = QuantileSketch(accuracy).update(pixels)
+
+	exact = numpy.percentile(pixels, PERCENTILES)
+	estimated = sketch.percentile(PERCENTILES)
+
+	assert numpy.all(numpy.abs(estimated - exact) <= accuracy * numpy.abs(exact) * (1 + 1e-9))
+
+
+def test_quantile_sketch_negative_and_small_values():
+	accuracy = 0.001
+	pixels = numpy.concatenate([-get_pixels(5000, 1), get_pixels(5000, 2), numpy.zeros(100), numpy.full(100, 1e-5)])
+
+	sketch = QuantileSketch(accuracy).update(pixels)
+
+	exact = numpy.percentile(pixels, PERCENTILES)
+	estimated = sketch.percentile(PERCENTILES)
+
+	assert numpy.all(numpy.abs(estimated - exact) <= accuracy * numpy.abs(exact) + sketch.min_value)
+
+
+def test_quantile_sketch_merge():
+	pixels = numpy.concatenate([get_pixels(5000, 1), -get_pixels(500, 2)])
+
+	sketch = QuantileSketch().update(pixels)
+	merged_sketch = QuantileSketch()
+	for part in numpy.array_split(pixels, 4):
+		merged_sketch.merge(QuantileSketch().update(part))
+
+	assert merged_sketch.count == sketch.count
+	assert numpy.array_equal(merged_sketch.percentile(PERCENTILES), sketch.percentile(PERCENTILES))
+
+	with pytest.raises(ValueError):
+		sketch.merge(QuantileSketch(0.01))
+
+	with pytest.raises(ValueError):
+		QuantileSketch().percentile(50)
+
+
+def get_image():
+	'''Return an image with some non finite pixels, and a mask of a subset of the pixels'''
+	image = get_pixels(100 * 80).reshape(100, 80)
+	image[3, 5] = numpy.nan
+	image[50, 10:20] = numpy.inf
+	rows, columns = numpy.indices(image.shape)
+	subset_mask = (rows - 40)**2 + (columns - 35)**2 > 30**2
+	return image, subset_mask
+
+
+@pytest.mark.parametrize('band_size', [None, 7])
+def test_split_stats_exact(band_size):
+	image, subset_mask = get_image()
+
+	split_stats = SplitStats(image.size)
+	if band_size is None:
+		split_stats.update(image, subset_mask)
+	else:
+		for start in range(0, image.shape[0], band_size):
+			split_stats.update(image[start:start + band_size], subset_mask[start:start + band_size])
+
+	(image_stats, image_percentiles), (subset_stats, subset_percentiles) = split_stats.get_results(PERCENTILES)
+
+	finite = numpy.isfinite(image)
+	for pixel_stats, percentiles, pixels in [(image_stats, image_percentiles, image[finite]), (subset_stats, subset_percentiles, image[finite & subset_mask])]:
+		assert pixel_stats.count == pixels.size
+		assert pixel_stats.mean == pytest.approx(pixels.mean(), rel = 1e-12)
+		assert pixel_stats.std == pytest.approx(pixels.std(), rel = 1e-12)
+		assert numpy.array_equal(percentiles, numpy.percentile(pixels, PERCENTILES))
+
+
+def test_split_stats_sketch():
+	accuracy = 0.001
+	image, subset_mask = get_image()
+
+	(image_stats, image_percentiles), (subset_stats, subset_percentiles) = SplitStats(image.size, 'sketch', accuracy).update(image, subset_mask).get_results(PERCENTILES)
+
+	finite = numpy.isfinite(image)
+	for percentiles, pixels in [(image_percentiles, image[finite]), (subset_percentiles, image[finite & subset_mask])]:
+		exact = numpy.percentile(pixels, PERCENTILES)
+		assert numpy.all(numpy.abs(percentiles - exact) <= accuracy * numpy.abs(exact) * (1 + 1e-9))
+
+	with pytest.raises(ValueError):
+		SplitStats(image.size, 'approximate')
@@ -0,0 +1,50 @@
+import os
+import sys
+import json
+
+import numpy
+import pandas
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scripts'))
+
+from plot_stats import get_downsample_positions, get_series_bundle
+
+
+def get_dataframe():
+	'''Return a dataframe of 40 rows with a column without missing values, and a column whose first half is missing'''
+
+	values = numpy.sin(numpy.arange(40))
+	partly_missing = values.copy()
+	partly_missing[:20] = numpy.nan
+
+	return pandas.DataFrame({'timestamp': numpy.arange(40) * 1000, 'VALUE': values, 'PARTLY_NAN': partly_missing})
+
+
+def test_downsample_positions_partly_nan_column():
+	dataframe = get_dataframe()
+
+	positions = get_downsample_positions(dataframe, 'PARTLY_NAN', 10)
+
+	assert 0 < len(positions) <= 10
+	assert numpy.all(numpy.diff(positions) > 0)
+	assert dataframe['PARTLY_NAN'].iloc[positions].notna().all()
+
+	# The extremes of the values are kept
+	assert dataframe['PARTLY_NAN'].idxmin() in positions
+	assert dataframe['PARTLY_NAN'].idxmax() in positions
+
+
+def test_downsample_positions_all_nan_column():
+	dataframe = get_dataframe()
+	dataframe['PARTLY_NAN'] = numpy.nan
+
+	assert len(get_downsample_positions(dataframe, 'PARTLY_NAN', 10)) == 0
+
+
+def test_series_bundle_partly_nan_column():
+	dataframe = get_dataframe()
+
+	bundle = json.loads(get_series_bundle('A', dataframe, ['VALUE', 'PARTLY_NAN'], 'black', max_points = 10))
+
+	assert len(bundle['timestamp']) == len(bundle['columns']['VALUE']) == len(bundle['columns']['PARTLY_NAN'])
+	assert 0 < len([value for value in bundle['columns']['PARTLY_NAN'] if value is not None]) <= 10
@@ -0,0 +1,71 @@
+import os
+import sys
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scripts'))
+
+from watch import DateWatcher
+
+START_DATE = datetime(2020, 1, 1)
+INTERVAL = timedelta(hours = 6)
+GRACE_PERIOD = timedelta(hours = 1)
+
+
+class FakeSdoData:
+	'''Stand-in for SdoData with the files available at each poll, and the dates whose search raises'''
+
+	def __init__(self):
+		self.files = dict()
+		self.failing_dates = set()
+
+	def clear_cache(self, dates = None, missing_only = False):
+		pass
+
+	def scan(self, dates, wavelengths):
+		if self.failing_dates.intersection(dates):
+			raise OSError('Cannot list directory')
+		return {(date, wavelength): self.files.get((date, wavelength)) for date in dates for wavelength in wavelengths}
+
+
+def test_date_ready_when_all_files_found():
+	sdo_data = FakeSdoData()
+	watcher = DateWatcher(sdo_data, [171, 193], START_DATE, INTERVAL, GRACE_PERIOD, end_date = START_DATE + INTERVAL)
+
+	sdo_data.files[(START_DATE, 171)] = 'AIA.171.fits'
+	assert watcher.poll(START_DATE + timedelta(minutes = 10)) == []
+
+	sdo_data.files[(START_DATE, 193)] = 'AIA.193.fits'
+	assert watcher.poll(START_DATE + timedelta(minutes = 20)) == [START_DATE]
+	assert watcher.finished
+
+
+def test_date_released_after_grace_period():
+	sdo_data = FakeSdoData()
+	watcher = DateWatcher(sdo_data, [171, 193], START_DATE, INTERVAL, GRACE_PERIOD)
+
+	sdo_data.files[(START_DATE, 171)] = 'AIA.171.fits'
+	first_seen = START_DATE + timedelta(minutes = 10)
+	assert watcher.poll(first_seen) == []
+	assert watcher.poll(first_seen + GRACE_PERIOD - timedelta(seconds = 1)) == []
+	assert watcher.poll(first_seen + GRACE_PERIOD) == [START_DATE]
+	assert not watcher.finished
+
+
+def test_date_without_files_released_after_next_date():
+	sdo_data = FakeSdoData()
+	watcher = DateWatcher(sdo_data, [171], START_DATE, INTERVAL, GRACE_PERIOD)
+
+	assert watcher.poll(START_DATE + INTERVAL + GRACE_PERIOD - timedelta(seconds = 1)) == []
+	assert watcher.poll(START_DATE + INTERVAL + GRACE_PERIOD) == [START_DATE]
+
+
+def test_failing_date_does_not_hold_other_dates():
+	sdo_data = FakeSdoData()
+	watcher = DateWatcher(sdo_data, [171], START_DATE, INTERVAL, GRACE_PERIOD, end_date = START_DATE + 2 * INTERVAL)
+
+	sdo_data.failing_dates.add(START_DATE)
+	sdo_data.files[(START_DATE + INTERVAL, 171)] = 'AIA.171.fits'
+
+	assert watcher.poll(START_DATE + INTERVAL) == [START_DATE + INTERVAL]
+	assert watcher.poll(START_DATE + INTERVAL + GRACE_PERIOD) == [START_DATE]
+	assert watcher.finished